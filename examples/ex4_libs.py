@@ -101,7 +101,7 @@ print foo, 'ninjas'
 
 # Get primitives as return values (supports int64_t, int32_t, double)
 x = 7
-bar = lib['foobar'](x=x)
+bar = lib['foobar'](d=x)
 print 'x(=%d) + helper = %s' % (x, bar)
 
 #
@@ -0,0 +1,44 @@
+import sys
+sys.path.append('python/')
+import pycpc
+import pycpc.bench
+import pycpc.vectors
+
+'''
+Comparing the runtime of a kernel compiled with different flags, using the
+benchmark harness instead of timing by hand (see ex5_timing.py)
+'''
+
+v = pycpc.vectors.CLongVector(size=1 << 17)
+v[:] = range(len(v))
+
+#
+# The harness builds the kernel once per context, so declare it in a function
+#
+def build(ctx):
+  lbuild = pycpc.CPPLibBuilder(ctx)
+  lbuild.decl_func('total', r'''
+  int64_t acc = 0;
+  for (int64_t i = 0; i < l; i++) {
+    acc += v[i];
+  }
+  return acc;
+  ''', v=v, l=long, rtype=long)
+  return lbuild
+
+#
+# The variants are compiled in parallel, then sampled in a random order.
+# Giving a seed makes the order the same each run.
+#
+report = pycpc.bench.compare(build, {
+    'O0' : pycpc.Context(flags=['O0']),
+    'O2' : pycpc.Context(flags=['O2']),
+    'O3 native' : pycpc.Context(flags=['O3', 'march=native']),
+  }, 'total', dict(v=v, l=len(v)), items=len(v), seed=0)
+
+# a line per variant: min, median with its 95% confidence interval, 90th
+# percentile, standard deviation, throughput and time relative to the fastest
+print report
+
+print 'O3 native is %.2fx faster than O0' % report['O3 native'].speedup(
+    report['O0'])[0]
@@ -1,6 +1,15 @@
 import context
+import cache
 import cppinl
+import bench
 import cmake
+import instrument
+import isa
+import kernels
+import mapped
+import parallel
+import stl
+import structs
 import os
 import sys
 
@@ -8,6 +17,15 @@ compile_and_load_source = cmake.compile_and_load_source
 CHandle = cppinl.CHandle
 CPPLibBuilder = context.CPPLibBuilder
 Context = context.Context
+compile_many = context.compile_many
+parallel_for = parallel.parallel_for
+elementwise = kernels.elementwise
+reduce = kernels.reduce
+MappedVector = mapped.MappedVector
+Struct = structs.Struct
+StdVector = stl.StdVector
+StdString = stl.StdString
+StdUnorderedMap = stl.StdUnorderedMap
 
 def invoke_main(main, cleanup=True):
   pid = os.fork()
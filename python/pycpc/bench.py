@@ -0,0 +1,277 @@
+import context
+import cppinl
+import math
+import random
+
+"""
+Microbenchmarks comparing builds of a kernel
+
+A kernel is a function declared with CPPLibBuilder.decl_func. compare builds
+it once per Context variant (eg. different compilers, flags or defines),
+compiling the variants concurrently, and times it with a native wrapper that
+calls the kernel in a loop between two reads of CLOCK_MONOTONIC, so the
+measurement does not include the cost of calling from python. After a
+warmup, samples of the variants are taken in a random order each round,
+which spreads drift (eg. frequency scaling, other processes) evenly over
+the variants.
+
+  def build(ctx):
+    lbuild = pycpc.CPPLibBuilder(ctx)
+    lbuild.decl_func('total', '...', v=v, l=long, rtype=long)
+    return lbuild
+
+  report = bench.compare(build, {'O0': pycpc.Context(flags=['O0']),
+      'O3': pycpc.Context(flags=['O3'])}, 'total', dict(v=v, l=len(v)),
+      items=len(v))
+  print report
+"""
+
+# added to the kernel arguments, the number of calls per sample
+NUMBER_ARG = 'pycpc_number'
+
+TIMER_SOURCE = r'''
+#include <time.h>
+static inline int64_t pycpc_bench_now() {
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return (int64_t) ts.tv_sec * 1000000000 + ts.tv_nsec;
+}
+'''
+
+
+def timer_name(name):
+  return 'pycpc_bench_' + name
+
+
+def timer_source(name, rtype, args):
+  ''' Returns C++ source of a function timing `number` calls of a kernel
+  It takes the arguments of the kernel and `pycpc_number`, and returns the
+  elapsed nanoseconds. The kernel is called through a volatile pointer so it
+  is not inlined into, or hoisted out of, the loop.
+  '''
+  params = cppinl.mangle_args(args)
+  ptypes = ', '.join(cppinl.get_cpp_type(v) for k, v in params)
+  rstr = cppinl.get_cpp_type(rtype)
+  call = 'fn(%s);' % ', '.join(k for k, v in params)
+  lines = ['%s (* volatile fn)(%s) = %s;' % (rstr, ptypes, name)]
+  if rtype is not None:
+    lines.append('volatile %s sink;' % rstr)
+    call = 'sink = ' + call
+  lines += ['int64_t start = pycpc_bench_now();',
+      'for (int64_t i = 0; i < %s; i++) {' % NUMBER_ARG,
+      '  ' + call,
+      '}',
+      'return pycpc_bench_now() - start;']
+  body = '\n'.join(lines)
+  return TIMER_SOURCE + cppinl.cpp_func_def(timer_name(name),
+      params + [(NUMBER_ARG, long)], body, rtype=long)
+
+
+def add_timer(lbuild, name):
+  ''' Adds the timing wrapper of the kernel `name` to a builder '''
+  if name not in lbuild.sigs:
+    raise ValueError('%s is not declared with decl_func' % name)
+  rtype, args = lbuild.sigs[name]
+  if NUMBER_ARG in args:
+    raise ValueError('%s is reserved for the benchmark' % NUMBER_ARG)
+  targs = dict(args)
+  targs[NUMBER_ARG] = long
+  lbuild.raw_source(timer_source(name, rtype, args))
+  lbuild.sigs[timer_name(name)] = (long, targs)
+
+
+class Timer(object):
+  ''' Times a kernel of a CPPLib built by a builder passed to add_timer '''
+  def __init__(self, lib, name, args):
+    self.fn = lib.function(timer_name(name))
+    order = [k for k, v in cppinl.order_args(lib.sigs[timer_name(name)][1])]
+    self.vals = [args.get(k) for k in order]
+    self.pos = order.index(NUMBER_ARG)
+    self.number = 1
+
+  def __call__(self, number=None):
+    ''' Returns the nanoseconds taken by number calls of the kernel '''
+    self.vals[self.pos] = number or self.number
+    return self.fn(*self.vals)
+
+  def calibrate(self, min_time):
+    ''' Picks the number of calls per sample, so a sample takes at least
+    min_time seconds (a clock read is tens of nanoseconds)
+    '''
+    number = 1
+    while self(number) < min_time * 1e9 and number < (1 << 30):
+      number *= 2
+    self.number = number
+    return number
+
+
+class Stats(object):
+  ''' Statistics of the time per call of a kernel, in seconds '''
+  def __init__(self, name, samples, number=1, items=None):
+    '''
+    \param samples list of seconds per call
+    \param number calls per sample
+    \param items work done per call (eg. elements), for throughput
+    '''
+    self.name = name
+    self.samples = sorted(samples)
+    self.number = number
+    self.items = items
+
+  def __len__(self):
+    return len(self.samples)
+
+  @property
+  def min(self):
+    return self.samples[0]
+
+  @property
+  def max(self):
+    return self.samples[-1]
+
+  @property
+  def mean(self):
+    return sum(self.samples) / len(self.samples)
+
+  @property
+  def median(self):
+    return self.percentile(50)
+
+  @property
+  def stdev(self):
+    if len(self.samples) < 2:
+      return 0.0
+    m = self.mean
+    return math.sqrt(sum((s - m) ** 2 for s in self.samples)
+        / (len(self.samples) - 1))
+
+  def percentile(self, p):
+    ''' Returns the p-th percentile, interpolating between samples
+    >>> Stats('x', [4., 1., 3., 2.]).percentile(50)
+    2.5
+    '''
+    s = self.samples
+    pos = (len(s) - 1) * p / 100.0
+    lo = int(math.floor(pos))
+    hi = min(lo + 1, len(s) - 1)
+    return s[lo] + (s[hi] - s[lo]) * (pos - lo)
+
+  def median_interval(self, z=1.96):
+    ''' Returns a (low, high) confidence interval of the median, 95% by
+    default, from the ranks of the samples. It assumes nothing about how the
+    times are distributed.
+    '''
+    n = len(self.samples)
+    half = z * math.sqrt(n) / 2
+    lo = max(0, int(math.floor(n / 2.0 - half)))
+    hi = min(n - 1, int(math.ceil(n / 2.0 + half)))
+    return self.samples[lo], self.samples[hi]
+
+  @property
+  def throughput(self):
+    ''' Items (or calls, if items is not given) per second at the median '''
+    return (self.items or 1) / self.median
+
+  def speedup(self, other):
+    ''' Returns how many times faster this is than other, by median, and a
+    (low, high) range from the medians' confidence intervals
+    '''
+    lo, hi = self.median_interval()
+    olo, ohi = other.median_interval()
+    return other.median / self.median, (olo / hi, ohi / lo)
+
+  def __str__(self):
+    lo, hi = self.median_interval()
+    unit = self.items and 'items/s' or 'calls/s'
+    return ('%-16s n=%-5d min %s  median %s [%s, %s]  p90 %s  stdev %s  '
+        '%.4g %s') % (self.name, len(self), _fmt(self.min), _fmt(self.median),
+        _fmt(lo), _fmt(hi), _fmt(self.percentile(90)), _fmt(self.stdev),
+        self.throughput, unit)
+
+
+def _fmt(seconds):
+  for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+    if seconds >= scale:
+      return '%.3g%s' % (seconds / scale, unit)
+  return '%.3gns' % (seconds / 1e-9)
+
+
+class Report(object):
+  ''' The results of compare, a Stats per variant '''
+  def __init__(self, stats, libs):
+    self.stats = stats
+    self.libs = libs
+
+  def __getitem__(self, name):
+    for s in self.stats:
+      if s.name == name:
+        return s
+    raise KeyError(name)
+
+  def best(self):
+    return min(self.stats, key=lambda s: s.median)
+
+  def __str__(self):
+    # each variant's time relative to the fastest
+    best = self.best()
+    lines = []
+    for s in self.stats:
+      x, (lo, hi) = best.speedup(s)
+      lines.append('%s  x%.3f [%.3f, %.3f]' % (s, x, lo, hi))
+    return '\n'.join(lines)
+
+
+def variant_name(ctx):
+  return ' '.join([ctx.cc] + ['-' + f for f in ctx.compile_flags()]
+      + ['-D' + d for d in ctx.defs])
+
+
+def compare(build, variants, name, args, repeat=200, warmup=20,
+    min_time=1e-4, items=None, seed=None, jobs=None):
+  ''' Benchmarks a kernel built with each of several contexts
+  \param build function taking a Context and returning a CPPLibBuilder which
+      declares the kernel with decl_func
+  \param variants dict of name to Context, or a list of Contexts
+  \param name the name of the kernel
+  \param args dict of the arguments to call the kernel with
+  \param repeat samples taken of each variant
+  \param warmup samples of each variant discarded before measuring
+  \param min_time seconds a sample lasts at least, short kernels are called
+      many times per sample
+  \param items the work done by a call (eg. number of elements), for throughput
+  \param seed seeds the order of samples, to repeat a run exactly
+  \param jobs number of compiler processes to run at once
+  \return a Report
+  '''
+  if isinstance(variants, dict):
+    variants = sorted(variants.items())
+  else:
+    variants = [(variant_name(ctx), ctx) for ctx in variants]
+
+  builders = []
+  for vname, ctx in variants:
+    lbuild = build(ctx)
+    add_timer(lbuild, name)
+    builders.append(lbuild)
+  libs = context.compile_many(builders, jobs=jobs)
+  for lib in libs:
+    if isinstance(lib, Exception):
+      raise lib
+
+  timers = [Timer(lib, name, args) for lib in libs]
+  for timer in timers:
+    timer.calibrate(min_time)
+    for i in range(warmup):
+      timer()
+
+  rand = random.Random(seed)
+  samples = [[] for t in timers]
+  order = range(len(timers))
+  for r in range(repeat):
+    rand.shuffle(order)
+    for i in order:
+      samples[i].append(timers[i]() * 1e-9 / timers[i].number)
+
+  stats = [Stats(vname, s, timer.number, items)
+      for (vname, ctx), s, timer in zip(variants, samples, timers)]
+  return Report(stats, libs)
@@ -0,0 +1,239 @@
+import os
+import hashlib
+import re
+import subprocess
+import tempfile
+import time
+
+"""
+Persistent, content addressed storage for compiled artifacts
+
+Shared objects (and other build products) are stored under CACHE_DIR with a
+name derived from a hash of everything that went into building them, so a
+later process compiling identical code can load the cached file instead of
+invoking the compiler. Headers the source includes from outside the
+compiler's own directories (`#include "..."`, or from the include
+directories given) are part of the key by their contents, so editing one
+rebuilds the code using it; finding them runs the preprocessor, which is
+skipped for sources without such includes. Files are written under a temporary name and moved
+into place with os.rename, which is atomic, so concurrent writers are safe.
+When the directory grows past MAX_SIZE, the least recently used entries are
+removed.
+
+The cache can be configured with the environment variables:
+  PYCPC_CACHE_DIR  location of the cache (default ~/.cache/pycpc)
+  PYCPC_CACHE_SIZE size limit in bytes (default 1GB)
+  PYCPC_CACHE=0    disables the cache
+"""
+
+CACHE_DIR = os.environ.get('PYCPC_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'pycpc'))
+MAX_SIZE = long(os.environ.get('PYCPC_CACHE_SIZE', 1 << 30))
+ENABLED = os.environ.get('PYCPC_CACHE', '1') != '0'
+
+# bump when the way artifacts are built changes
+FORMAT_VERSION = 1
+
+# temporary files older than this (seconds) are assumed to be abandoned
+STALE_TEMP_AGE = 24 * 60 * 60
+
+_cc_versions = {}
+
+# (path, mtime, size) -> digest of headers, so unchanged ones are not read
+# again
+_header_digests = {}
+
+
+def set_cache_dir(path):
+  ''' Sets the directory where compiled artifacts are stored '''
+  global CACHE_DIR
+  CACHE_DIR = path
+
+
+def set_max_size(nbytes):
+  ''' Sets the size limit of the cache directory in bytes '''
+  global MAX_SIZE
+  MAX_SIZE = long(nbytes)
+
+
+def enable():
+  global ENABLED
+  ENABLED = True
+
+
+def disable():
+  global ENABLED
+  ENABLED = False
+
+
+def compiler_version(cc):
+  ''' Returns the output of `cc --version`, which is part of every key
+  The result is remembered for the lifetime of the process.
+  '''
+  if cc not in _cc_versions:
+    try:
+      proc = subprocess.Popen([cc, '--version'], stdout=subprocess.PIPE,
+          stderr=subprocess.PIPE)
+      out, __ = proc.communicate()
+    except OSError:
+      out = ''
+    _cc_versions[cc] = out
+  return _cc_versions[cc]
+
+
+def file_digest(path):
+  ''' Returns the sha256 hex digest of the contents of a file '''
+  h = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 16), ''):
+      h.update(block)
+  return h.hexdigest()
+
+
+def header_digests(src, cc="g++", flags=[], includes=[], defs=[]):
+  ''' Returns [(path, digest)] of the headers src includes, except those of
+  the compiler and system, as listed by the preprocessor (`cc -MM`)
+  Nothing is run for a source without quoted includes when no include
+  directories are given. If the preprocessor fails, so will the compiler,
+  and nothing is listed.
+  '''
+  if not includes and '#include "' not in src:
+    return []
+  argv = [cc] + ['-' + f for f in flags] + ['-I' + i for i in includes] \
+      + ['-D' + d for d in defs] + ['-MM', '-x', 'c++', '-']
+  try:
+    proc = subprocess.Popen(argv, stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, __ = proc.communicate(src)
+  except OSError:
+    return []
+  if proc.returncode != 0:
+    return []
+  # a make rule "-: a.h b\ c.h", spaces in names are escaped and lines end
+  # with a backslash
+  deps = out.split(':', 1)[-1].replace('\\\n', ' ')
+  digests = []
+  for path in re.split(r'(?<!\\)\s+', deps.strip()):
+    if not path:
+      continue
+    path = os.path.abspath(path.replace('\\ ', ' '))
+    try:
+      st = os.stat(path)
+    except OSError:
+      continue
+    stamp = (path, st.st_mtime, st.st_size)
+    if stamp not in _header_digests:
+      _header_digests[stamp] = file_digest(path)
+    digests.append((path, _header_digests[stamp]))
+  return digests
+
+
+def make_key(*parts):
+  ''' Hashes an arbitrary tuple of strings and lists into a cache key
+  >>> make_key('a', ['b']) == make_key('a', ['b'])
+  True
+  >>> make_key('a', ['b']) == make_key('a', ['c'])
+  False
+  '''
+  return hashlib.sha256(repr((FORMAT_VERSION,) + parts)).hexdigest()
+
+
+def build_key(src, obj_files=[], cc="g++", flags=[], includes=[], links=[],
+    defs=[]):
+  ''' Computes the key of a shared object built from a source string
+  \param src C++ source code
+  \param obj_files object files linked into the library, hashed by content
+  \return a hex string
+  Included headers are hashed by content, see header_digests.
+  '''
+  return make_key('so', src, cc, compiler_version(cc), list(flags),
+      list(includes), list(links), list(defs),
+      [file_digest(o) for o in obj_files],
+      header_digests(src, cc, flags, includes, defs))
+
+
+def path_for(key, suffix):
+  return os.path.join(CACHE_DIR, key + suffix)
+
+
+def lookup(key, suffix='.so'):
+  ''' Returns the path of a cached artifact or None
+  A hit refreshes the entry's modification time, which is used for LRU eviction.
+  '''
+  path = path_for(key, suffix)
+  try:
+    os.utime(path, None)
+  except OSError:
+    return None
+  return path
+
+
+def fetch(key, suffix, build):
+  ''' Returns the path to a cached artifact, building it on a miss
+  \param key a key from make_key or build_key
+  \param suffix file extension of the artifact (eg. '.so')
+  \param build function taking the output path which creates the artifact
+  \return (path, hit) where hit is True if nothing was built
+  '''
+  path = lookup(key, suffix)
+  if path is not None:
+    return path, True
+  if not os.path.isdir(CACHE_DIR):
+    try:
+      os.makedirs(CACHE_DIR)
+    except OSError:
+      # another process may have created it first
+      if not os.path.isdir(CACHE_DIR):
+        raise
+  fd, tmp = tempfile.mkstemp(suffix=suffix, prefix='tmp', dir=CACHE_DIR)
+  os.close(fd)
+  try:
+    build(tmp)
+    os.chmod(tmp, 0755)
+    os.rename(tmp, path_for(key, suffix))
+  except:
+    if os.path.exists(tmp):
+      os.unlink(tmp)
+    raise
+  evict()
+  return path_for(key, suffix), False
+
+
+def evict(max_size=None):
+  ''' Removes least recently used entries until the cache fits in max_size '''
+  if max_size is None:
+    max_size = MAX_SIZE
+  now = time.time()
+  entries = []
+  total = 0
+  for name in os.listdir(CACHE_DIR):
+    path = os.path.join(CACHE_DIR, name)
+    try:
+      st = os.stat(path)
+    except OSError:
+      continue
+    if name.startswith('tmp'):
+      # in-progress writes of other processes, unless long abandoned
+      if now - st.st_mtime > STALE_TEMP_AGE:
+        _unlink(path)
+      continue
+    entries.append((st.st_mtime, st.st_size, path))
+    total += st.st_size
+  entries.sort()
+  for mtime, size, path in entries:
+    if total <= max_size:
+      break
+    _unlink(path)
+    total -= size
+
+
+def clear():
+  ''' Removes every entry from the cache '''
+  evict(max_size=0)
+
+
+def _unlink(path):
+  try:
+    os.unlink(path)
+  except OSError:
+    pass
@@ -1,12 +1,28 @@
 import os
+import sys
 import ctypes
+import shlex
+import signal
 import tempfile
+import threading
+import subprocess
 import cppinl
+import cache
+import instrument
+import pool
 import shutil
 
 # hold object and source files
 TEMP_DIR = tempfile.mkdtemp()
 
+# seconds a compiler process may run before it is killed, None for no limit
+TIMEOUT = None
+
+# if True, warnings of successful compiles are written to stderr
+ECHO_WARNINGS = True
+
+_local = threading.local()
+
 # cleans up after execution
 def del_temp_dir():
   shutil.rmtree(TEMP_DIR)
@@ -18,7 +34,7 @@ def invoke_function(fn, *vals):
     if type(v) is float:
       argv.append(ctypes.c_double(v))
     elif isinstance(v, cppinl.CHandle):
-      argv.append(v.ptr)
+      argv.append(v._as_parameter_)
     else:
       argv.append(v)
   try:
@@ -29,7 +45,178 @@ def invoke_function(fn, *vals):
     print 'Arguments: ', ', '.join(map(repr, vals))
     raise
 
-class CompileError(Exception): pass
+def bind_function(lib, name, rtype=None, args={}):
+  """ Gets a function from a library with argtypes and restype set
+  The returned ctypes function is called positionally, with arguments in the
+  order of the C++ declaration (sorted by name, see cppinl.order_args).
+  \param lib a library loaded by compile_and_load
+  \param name the name of the extern "C" function
+  \param rtype the return type (eg. long), None for void
+  \param args dict of argument names to types or example values
+  """
+  fn = lib[name]
+  fn.argtypes = [cppinl.get_argtype(v) for k, v in cppinl.order_args(args)]
+  fn.restype = cppinl.get_restype(rtype)
+  return fn
+
+class CompileError(Exception):
+  """ A compiler process failed
+  \param argv the command which was run
+  \param output what the compiler wrote to stdout and stderr
+  \param returncode the exit status of the compiler
+  """
+  def __init__(self, message, argv=None, output='', returncode=None):
+    Exception.__init__(self, message)
+    self.message = message
+    self.argv = argv
+    self.output = output
+    self.returncode = returncode
+
+  def __str__(self):
+    if not self.output:
+      return self.message
+    return '%s\n%s' % (self.message, self.output)
+
+class CompileTimeout(CompileError): pass
+
+class CompileCancelled(CompileError): pass
+
+
+class JobGroup(object):
+  """ Compiler processes started for one request
+  Each process gets the group's timeout, and they can be cancelled together.
+  As a context manager, it applies to every compile on the current thread,
+  and may be entered again (eg. by a thread which is already in it):
+
+      with cmake.JobGroup(timeout=30):
+        lib = builder.make()
+  """
+  def __init__(self, timeout=None):
+    self.timeout = timeout
+    self.cancelled = False
+    self.procs = set()
+    self.lock = threading.Lock()
+
+  def cancel(self):
+    """ Kills running compilers, later compiles in the group fail at once """
+    with self.lock:
+      self.cancelled = True
+      procs = list(self.procs)
+    for proc in procs:
+      _kill(proc)
+
+  def __enter__(self):
+    # a stack per thread, not an attribute, as the group may be entered on
+    # several threads and more than once on one
+    _local.__dict__.setdefault('groups', []).append(self)
+    return self
+
+  def __exit__(self, *exc):
+    _local.groups.pop()
+
+
+def current_group():
+  """ Returns the innermost JobGroup entered on this thread, or None """
+  groups = getattr(_local, 'groups', None)
+  return groups[-1] if groups else None
+
+
+def _kill(proc):
+  ''' Kills a compiler and the processes it started (eg. cc1plus, as) '''
+  try:
+    os.killpg(proc.pid, signal.SIGKILL)
+  except OSError:
+    # already exited
+    pass
+
+
+def run_compiler(argv, stdin=None, timeout=None):
+  """ Runs a compiler command, capturing its output
+  \param argv the command as a list of arguments, no shell is involved
+  \param stdin a string written to the compiler's standard input
+  \param timeout seconds before the compiler is killed, defaults to the
+      timeout of the current JobGroup, then TIMEOUT
+  \return the output of the compiler
+  """
+  group = current_group()
+  if timeout is None:
+    timeout = group.timeout if group is not None and group.timeout else TIMEOUT
+  cmdline = ' '.join(argv)
+  if group is not None and group.cancelled:
+    raise CompileCancelled('cancelled: %s' % cmdline, argv)
+
+  # in its own process group, so _kill reaches the compiler's children
+  try:
+    proc = subprocess.Popen(argv, close_fds=True, preexec_fn=os.setpgrp,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        stdin=subprocess.PIPE if stdin is not None else None)
+  except OSError, e:
+    # eg. the compiler does not exist
+    raise CompileError('failed: %s' % cmdline, argv, '%s: %s' % (argv[0],
+        e.strerror or e))
+  if group is not None:
+    with group.lock:
+      group.procs.add(proc)
+    if group.cancelled:
+      _kill(proc)
+  expired = []
+  timer = None
+  if timeout is not None:
+    def expire():
+      expired.append(True)
+      _kill(proc)
+    timer = threading.Timer(timeout, expire)
+    timer.daemon = True
+    timer.start()
+  try:
+    out, __ = proc.communicate(stdin)
+  finally:
+    if timer is not None:
+      timer.cancel()
+    if group is not None:
+      with group.lock:
+        group.procs.discard(proc)
+
+  if expired:
+    raise CompileTimeout('timed out after %ss: %s' % (timeout, cmdline), argv,
+        out, proc.returncode)
+  if group is not None and group.cancelled:
+    raise CompileCancelled('cancelled: %s' % cmdline, argv, out, 
+        proc.returncode)
+  if proc.returncode != 0:
+    raise CompileError('failed: %s' % cmdline, argv, out, proc.returncode)
+  if out and ECHO_WARNINGS:
+    sys.stderr.write(out)
+  return out
+
+
+def submit(fn, args=(), kwargs={}, timeout=None):
+  """ Runs fn(*args, **kwargs) in the background in its own JobGroup
+  \return a pool.Future, cancel() on it kills the compilers fn started
+  """
+  group = JobGroup(timeout=timeout)
+  def run():
+    with group:
+      if group.cancelled:
+        raise CompileCancelled('cancelled')
+      return fn(*args, **kwargs)
+  fut = pool.shared_pool().submit(run)
+  fut.set_canceller(group.cancel)
+  return fut
+
+
+def _args(prefix, items):
+  """ Command line arguments for a list of flags, eg. _args('-D', ['FOO'])
+  Items holding several arguments (eg. 'include foo.h') are split like the
+  shell would.
+  """
+  argv = []
+  for item in items:
+    if any(c.isspace() for c in item):
+      argv.extend(shlex.split(prefix + item))
+    else:
+      argv.append(prefix + item)
+  return argv
 
 def compile_bin(out_name, src_files, cc="g++", flags=['O3', 'Wall'], 
     includes=[], links=[], defs=[], lib=False):
@@ -47,17 +234,80 @@ def compile_bin(out_name, src_files, cc="g++", flags=['O3', 'Wall'],
   if lib:
     flags.append('c')
     flags.append('fPIC')
-  lnks = ' '.join(map(lambda s: '-l%s'%s, links))
-  incl = ' '.join(map(lambda s: '-I%s'%s, includes))
-  flgs = ' '.join(map(lambda s: '-%s'%s, flags))
-  dfs = ' '.join(map(lambda s: '-D%s'%s, defs))
-  srcs = ' '.join(src_files)
-
-  cmdline = '{0} {1} {2} {3} {4} {5} -o {6}'.format(cc, flgs, lnks, incl, srcs, 
-      dfs, out_name)
-  rcode = os.system("%s 1>/dev/null" % cmdline)
-  if rcode != 0:
-    raise CompileError('failed: %s\n source: %s' % (cmdline, srcs))
+  argv = [cc] + _args('-', flags) + _args('-I', includes) + list(src_files) \
+      + _args('-D', defs) + ['-o', out_name] + _args('-l', links)
+  run_compiler(argv)
+
+def compile_pch(out_name, header, cc="g++", flags=['O3', 'Wall'], includes=[],
+    defs=[]):
+  """ Precompiles a header for sources compiled with compile_bin(lib=True)
+  \param out_name the precompiled header, header + '.gch' to be found by the
+      compiler (eg. '~/inc/foo.h.gch')
+  \param header the header file (eg. '~/inc/foo.h')
+  The remaining parameters are the same as compile_bin.
+  """
+  flags = list(flags) + ['fPIC']
+  argv = [cc] + _args('-', flags) + _args('-I', includes) + _args('-D', defs) \
+      + ['-x', 'c++-header', header, '-o', out_name]
+  run_compiler(argv)
+
+
+def cached_build(key, suffix, build):
+  """ Returns the path of an artifact, building it only if it does not exist
+  The artifact is kept in the compilation cache when it is enabled, and
+  in TEMP_DIR for the life of the process otherwise.
+  \param key a key from cache.make_key
+  \param suffix file extension of the artifact (eg. '.o')
+  \param build function taking the output path which creates the artifact
+  """
+  if cache.ENABLED:
+    path, __ = cache.fetch(key, suffix, build)
+    return path
+  path = _temp_path(key, suffix)
+  if not os.path.exists(path):
+    fd, tmp = tempfile.mkstemp(suffix=suffix, dir=TEMP_DIR)
+    os.close(fd)
+    try:
+      build(tmp)
+      os.rename(tmp, path)
+    except:
+      if os.path.exists(tmp):
+        os.unlink(tmp)
+      raise
+  return path
+
+
+def _temp_path(key, suffix):
+  return os.path.join(TEMP_DIR, key + suffix)
+
+
+def is_built(key, suffix):
+  """ Returns True if cached_build(key, suffix, ...) will not build """
+  if cache.ENABLED:
+    return cache.lookup(key, suffix) is not None
+  return os.path.exists(_temp_path(key, suffix))
+
+
+def precompile_header(prelude, cc="g++", flags=['O3', 'Wall'], includes=[],
+    defs=[]):
+  """ Writes a header and its precompiled version, reusing earlier ones
+  The header is stored in the compilation cache when it is enabled, so other
+  processes share it, and in TEMP_DIR otherwise.
+  \param prelude the text of the header (eg. '#include <vector>')
+  The remaining parameters are the same as compile_bin.
+  \return the path to the header, to be included first in a source file
+  """
+  key = cache.make_key('pch', prelude, cc, cache.compiler_version(cc), 
+      list(flags), list(includes), list(defs), 
+      cache.header_digests(prelude, cc, flags, includes, defs))
+  def write_header(out):
+    with open(out, 'w') as f:
+      f.write(prelude + '\n')
+  header = cached_build(key, '.h', write_header)
+  cached_build(key, '.h.gch', lambda out: compile_pch(out, header, cc=cc, 
+      flags=flags, includes=includes, defs=defs))
+  return header
+
 
 def compile_so(outname, obj_files, cc="g++", links=[]):
   """ Compiles a shared object from object files
@@ -65,14 +315,55 @@ def compile_so(outname, obj_files, cc="g++", links=[]):
   \param obj_files name of files to compile (eg. ['~/obj/foo.o'])
   \param cc the c++ compiler (eg. '/usr/bin/g++')
   """
-  objs = ' '.join(obj_files)
   libname = os.path.basename(outname)
-  link_args = ' '.join(map(lambda s:'-l%s'%s, links))
-  cmdline = '{0} -shared -Wl,-soname,{1} -o {2} {3} {4}'.format(cc, libname, 
-      outname, objs, link_args)
-  rcode = os.system("%s 1>/dev/null" % cmdline)
-  if rcode != 0:
-    raise CompileError('failed: %s' % cmdline)
+  argv = [cc, '-shared', '-Wl,-soname,%s' % libname, '-o', outname] \
+      + list(obj_files) + _args('-l', links)
+  run_compiler(argv)
+
+
+def build_so(lib_name, src_files, obj_files=[], cc="g++", flags=['O3', 'Wall'],
+    includes=[], links=[], defs=[]):
+  """ Compile source files into a shared object at the given path
+  \param lib_name path to the output (eg. '/tmp/libfoo.so')
+  \param src_files list of source fiels (eg. ['~/src/foo.cc'])
+  \param obj_files name of files to compile (eg. ['~/obj/foo.o'])
+  The remaining parameters are the same as compile_bin.
+  """
+  __, obj_name = tempfile.mkstemp(suffix='.o', dir=TEMP_DIR)
+  os.close(__)
+  try:
+    compile_bin(obj_name, src_files, cc=cc, flags=flags, includes=includes,
+        links=links, defs=defs, lib=True)
+    # add the newly compiled object file to the list of objects for the lib
+    obj_files = list(obj_files)
+    obj_files.append(obj_name)
+    compile_so(lib_name, obj_files, cc=cc, links=links)
+  finally:
+    if os.path.exists(obj_name):
+      os.unlink(obj_name)
+
+
+def load_library(lib_name, src_files=[]):
+  """ Loads a compiled shared object
+  \param lib_name path to the shared object
+  \param src_files the source files used to build it, for error reporting
+  """
+  try:
+    return ctypes.CDLL(lib_name)
+  except OSError:
+    print "Failed link with library, source files:"
+    print ', '.join(src_files)
+    raise
+
+
+def hold_gil(lib):
+  """ Returns the library loaded with ctypes.PyDLL, whose functions are
+  called without releasing the GIL (ctypes.CDLL releases it for each call)
+  \param lib a library returned by load_library
+  """
+  if isinstance(lib, ctypes.PyDLL):
+    return lib
+  return ctypes.PyDLL(lib._name, handle=lib._handle)
 
 
 def compile_and_load(src_files, obj_files=[], cc="g++", flags=['O3', 'Wall'], 
@@ -87,35 +378,65 @@ def compile_and_load(src_files, obj_files=[], cc="g++", flags=['O3', 'Wall'],
   \param defs list of names to define with -D (eg. ['ENABLE_FOO'])
   \return (lib, fin) link to the library and a function to call to close the library
   """
-  __, obj_name = tempfile.mkstemp(suffix='.o', dir=TEMP_DIR)
-  os.close(__)
   __, lib_name = tempfile.mkstemp(suffix='.so', dir=TEMP_DIR)
   os.close(__)
 
-  compile_bin(obj_name, src_files, cc=cc, flags=flags, includes=includes, 
-      links=links, defs=defs, lib=True)
-  # add the newly compiled object file to the list of objects for the lib
-  obj_files = list(obj_files)
-  obj_files.append(obj_name)
-  compile_so(lib_name, obj_files, cc=cc, links=links)
+  build_so(lib_name, src_files, obj_files=obj_files, cc=cc, flags=flags,
+      includes=includes, links=links, defs=defs)
   def finalize():
-    if os.path.exists(obj_name):
-      os.unlink(obj_name)
     if os.path.exists(lib_name):
       os.unlink(lib_name)
+  return load_library(lib_name, src_files), finalize
+
+
+def compile_source_so(lib_name, src, cc="g++", flags=['O3', 'Wall'],
+    includes=[], links=[], defs=[]):
+  """ Compiles C++ source code into a shared object with one compiler run
+  The source is piped to the compiler, no source or object file is written.
+  \param lib_name path to the output (eg. '/tmp/libfoo.so')
+  \param src C++ source code
+  The remaining parameters are the same as compile_bin.
+  """
+  libname = os.path.basename(lib_name)
+  argv = [cc] + _args('-', flags) + ['-fPIC', '-shared'] \
+      + _args('-I', includes) + _args('-D', defs) \
+      + ['-Wl,-soname,%s' % libname, '-o', lib_name, '-x', 'c++', '-'] \
+      + _args('-l', links)
+  run_compiler(argv, stdin=src)
+
+
+def compile_source_obj(obj_name, src, cc="g++", flags=['O3', 'Wall'],
+    includes=[], defs=[]):
+  """ Compiles C++ source code, piped to the compiler, into an object file
+  \param obj_name path to the output (eg. '/tmp/foo.o')
+  \param src C++ source code
+  The remaining parameters are the same as compile_bin.
+  """
+  argv = [cc] + _args('-', flags) + ['-c', '-fPIC'] + _args('-I', includes) \
+      + _args('-D', defs) + ['-o', obj_name, '-x', 'c++', '-']
+  run_compiler(argv, stdin=src)
+
+
+def _build_so_from_source(lib_name, src, obj_files=[], **kwargs):
+  if not obj_files:
+    compile_source_so(lib_name, src, **kwargs)
+    return
+  # other objects are linked in, so this needs an object file of its own
+  fd, src_file = tempfile.mkstemp(suffix='.cc', dir=TEMP_DIR)
+  os.write(fd, src)
+  os.close(fd)
   try:
-    lib = ctypes.CDLL(lib_name)
-    return lib, finalize
-  except OSError:
-    print "Failed link with library, source files:"
-    print ', '.join(src_files)
-    raise
+    build_so(lib_name, [src_file], obj_files=obj_files, **kwargs)
+  finally:
+    os.unlink(src_file)
 
 
 def compile_and_load_source(src, obj_files=[], cc="g++", flags=['O3', 'Wall'], 
     includes=[], links=[], defs=[]):
   """ Compile and load a shared object from a source string
   This is a convienent way to call compile_and_load
+  If the compilation cache is enabled (see cache.py), a shared object built
+  from the same source, compiler and flags is loaded without compiling.
   \param src C++ source code
   \param cc the path to the c++ compiler
   \param obj_files name of files to compile (eg. ['~/obj/foo.o'])
@@ -125,10 +446,170 @@ def compile_and_load_source(src, obj_files=[], cc="g++", flags=['O3', 'Wall'],
   \param defs list of names to define with -D (eg. ['ENABLE_FOO'])
   \return (lib, fin) link to the library and a function to call to close the library
   """
-  fd, src_file = tempfile.mkstemp(suffix='.cc', dir=TEMP_DIR)
-  os.write(fd, src)
-  os.close(fd)
-  lib, fin = compile_and_load([src_file], obj_files=obj_files, cc=cc, flags=flags,
-      includes=includes, links=links, defs=defs)
-  os.unlink(src_file)
-  return lib, fin
+  opts = dict(obj_files=obj_files, cc=cc, flags=flags, includes=includes,
+      links=links, defs=defs)
+  if instrument.ENABLED:
+    start = instrument.now()
+  if cache.ENABLED:
+    key = cache.build_key(src, **opts)
+    lib_name, hit = cache.fetch(key, '.so',
+        lambda out: _build_so_from_source(out, src, **opts))
+    lib = load_library(lib_name)
+    if instrument.ENABLED:
+      instrument.record_compile(instrument.now() - start, hit, lib_name)
+    # the cached file outlives this process, nothing to clean up
+    return lib, lambda: None
+
+  __, lib_name = tempfile.mkstemp(suffix='.so', dir=TEMP_DIR)
+  os.close(__)
+  _build_so_from_source(lib_name, src, **opts)
+  def finalize():
+    if os.path.exists(lib_name):
+      os.unlink(lib_name)
+  lib = load_library(lib_name)
+  if instrument.ENABLED:
+    instrument.record_compile(instrument.now() - start, False, lib_name)
+  return lib, finalize
+
+
+def build_source(src, obj_files=[], cc="g++", flags=['O3', 'Wall'],
+    includes=[], links=[], defs=[]):
+  """ Compiles a shared object from a source string into the compilation
+  cache, without loading it (eg. for other hosts sharing the cache)
+  The parameters are the same as compile_and_load_source.
+  \return the path of the shared object, None if the cache is disabled since
+      it would not be kept
+  """
+  if not cache.ENABLED:
+    return None
+  opts = dict(obj_files=obj_files, cc=cc, flags=flags, includes=includes,
+      links=links, defs=defs)
+  key = cache.build_key(src, **opts)
+  lib_name, __ = cache.fetch(key, '.so',
+      lambda out: _build_so_from_source(out, src, **opts))
+  return lib_name
+
+
+def compile_and_load_sources(srcs, obj_files=[], cc="g++", 
+    flags=['O3', 'Wall'], includes=[], links=[], defs=[], jobs=None):
+  """ Compile and load a shared object from several source strings
+  Each source is compiled into its own object file, named by a hash of its
+  contents, and the objects are linked. An unchanged source reuses its object
+  from an earlier build, so after editing one source only that source is
+  compiled before linking. Objects are compiled concurrently,
+  or in turn when called from a WorkerPool job.
+  \param srcs list of C++ sources, each a complete translation unit
+  \param jobs number of compiler processes to run at once
+  The remaining parameters are the same as compile_and_load_source.
+  \return (lib, fin) link to the library and a function to call to close the library
+  """
+  if instrument.ENABLED:
+    start = instrument.now()
+  version = cache.compiler_version(cc)
+  def build_obj(src):
+    key = cache.make_key('o', src, cc, version, list(flags), list(includes), 
+        list(defs), cache.header_digests(src, cc, flags, includes, defs))
+    return cached_build(key, '.o', lambda out: compile_source_obj(out, src, 
+        cc=cc, flags=flags, includes=includes, defs=defs))
+
+  group = current_group()
+  def build_in_group(src):
+    # compiles on worker threads belong to the caller's JobGroup
+    if group is None:
+      return build_obj(src)
+    with group:
+      return build_obj(src)
+
+  if pool.in_worker() or jobs == 1:
+    # already one of a pool's jobs (eg. compile_many), which bounds the
+    # compilers running at once, a pool per build would multiply them
+    objs = map(build_in_group, srcs)
+  else:
+    workers = pool.WorkerPool(jobs)
+    try:
+      objs = [fut.result() for fut in workers.map(build_in_group, srcs)]
+    finally:
+      workers.shutdown()
+
+  all_objs = objs + list(obj_files)
+  key = cache.make_key('link', [os.path.basename(o) for o in objs], 
+      [cache.file_digest(o) for o in obj_files], cc, version, list(links))
+  hit = instrument.ENABLED and is_built(key, '.so')
+  lib_name = cached_build(key, '.so', lambda out: compile_so(out, all_objs, 
+      cc=cc, links=links))
+  lib = load_library(lib_name)
+  if instrument.ENABLED:
+    instrument.record_compile(instrument.now() - start, hit, lib_name)
+  # kept for later builds, like the objects
+  return lib, lambda: None
+
+
+# linked into instrumented libraries, writes the profile while loaded
+GCOV_DUMP_SOURCE = r'''
+extern "C" void __gcov_dump(void);
+extern "C" void pycpc_gcov_dump() { __gcov_dump(); }
+'''
+
+def compile_and_load_pgo(src, train, obj_files=[], cc="g++", 
+    flags=['O3', 'Wall'], includes=[], links=[], defs=[]):
+  """ Compile and load a shared object optimized with a profile (gcc's PGO)
+  The source is built with -fprofile-generate and train(lib, fin) is called
+  with the loaded instrumented library. The profile it writes is then used
+  to build the library again with -fprofile-use. The source, profile and
+  optimized library are kept like cached_build, if they exist train is not
+  called.
+  \param src C++ source code
+  \param train function running a representative workload on the library
+  The remaining parameters are the same as compile_and_load_source.
+  \return (lib, fin) link to the optimized library and a function to call
+      to close the library
+  """
+  opts = dict(obj_files=obj_files, cc=cc, flags=flags, includes=includes,
+      links=links, defs=defs)
+  key = cache.make_key('pgo', cache.build_key(src, **opts))
+
+  def write_source(out):
+    with open(out, 'w') as f:
+      f.write(src)
+
+  def build_obj(work, extra):
+    # the profile is checked against the path of the source, so both builds
+    # compile the same file
+    src_file = cached_build(key, '.cc', write_source)
+    obj_name = os.path.join(work, 'pgo.o')
+    compile_bin(obj_name, [src_file], cc=cc, flags=list(flags) + extra,
+        includes=includes, defs=defs, lib=True)
+    return obj_name
+
+  def build_profile(out):
+    work = tempfile.mkdtemp(dir=TEMP_DIR)
+    try:
+      obj_name = build_obj(work, ['fprofile-generate'])
+      dump_src = os.path.join(work, 'dump.cc')
+      with open(dump_src, 'w') as f:
+        f.write(GCOV_DUMP_SOURCE)
+      dump_obj = os.path.join(work, 'dump.o')
+      compile_bin(dump_obj, [dump_src], cc=cc, lib=True)
+      lib_name = os.path.join(work, 'libpgo.so')
+      compile_so(lib_name, [obj_name, dump_obj] + list(obj_files), cc=cc,
+          links=['gcov'] + list(links))
+      lib = load_library(lib_name)
+      train(lib, lambda: None)
+      lib.pycpc_gcov_dump()
+      shutil.copy(os.path.join(work, 'pgo.gcda'), out)
+    finally:
+      shutil.rmtree(work, ignore_errors=True)
+
+  def build_optimized(out):
+    profile = cached_build(key, '.gcda', build_profile)
+    work = tempfile.mkdtemp(dir=TEMP_DIR)
+    try:
+      shutil.copy(profile, os.path.join(work, 'pgo.gcda'))
+      obj_name = build_obj(work, ['fprofile-use', 'fprofile-correction',
+          'Wno-missing-profile'])
+      compile_so(out, [obj_name] + list(obj_files), cc=cc, links=links)
+    finally:
+      shutil.rmtree(work, ignore_errors=True)
+
+  lib_name = cached_build(key, '.so', build_optimized)
+  return load_library(lib_name), lambda: None
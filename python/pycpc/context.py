@@ -1,13 +1,24 @@
+import cache
 import cmake
 import cppinl
 import ctypes
+import instrument
+import itertools
+import os
+import pool
+import sys
+import threading
 
 
+# the name of the function generated for inline calls
+INLINE_NAME = 'temp2e5e3662020b4edea3ab3a5598010207'
+
+_context_ids = itertools.count()
 
 
 class Context(object):
   def __init__(self, obj_files=[], cc="g++", flags=['O3', 'Wall'], includes=[], 
-      links=[], defs=[], macros=[], name_spaces=[]):
+      links=[], defs=[], macros=[], name_spaces=[], pch=False, openmp=False):
     """ 
     \param src C++ source code
     \param cc the path to the c++ compiler
@@ -16,6 +27,8 @@ class Context(object):
     \param includes list of directories to include (eg. ['~/includes/'])
     \param links list of libraries to link with (eg. ['pthread', 'gtest'])
     \param defs list of names to define with -D (eg. ['ENABLE_FOO'])
+    \param pch if True, the macros are compiled once into a precompiled header
+    \param openmp if True, compiles with OpenMP (see use_openmp)
     """
     self.obj_files = obj_files[:]
     self.cc = cc
@@ -25,65 +38,277 @@ class Context(object):
     self.defs = defs[:]
     self.macros = macros[:]
     self.name_spaces = name_spaces[:]
+    self.pch = pch
+    self.openmp = False
+    # identifies this context in caches, version counts changes made to it
+    self.uid = next(_context_ids)
+    self.version = 0
     self.add_basic_libs()
+    if openmp:
+      self.use_openmp()
 
   def clone(self):
     return Context(self.obj_files, self.cc, self.flags, self.includes, 
-        self.links, self.defs, self.macros, self.name_spaces)
+        self.links, self.defs, self.macros, self.name_spaces, self.pch, 
+        self.openmp)
 
   def add_basic_libs(self):
     ''' Adds include statements for commonly used libraries
     '''
     self.macros.extend(['#include <cstdio>', '#include <cstdlib>', 
         '#include <inttypes.h>', '#include <string>', '#include <cstring>'])
+    self.changed()
 
   def add_macro(self, mac):
     self.macros.append(mac)
+    self.changed()
 
   def add_macros(self, mac):
     self.macros.extend(mac)
+    self.changed()
 
   def use_namespace(self, ns):
     self.name_spaces.append('using namespace %s;' % ns)
+    self.changed()
+
+  def use_pch(self, enable=True):
+    ''' Compiles the macros into a precompiled header which every library
+    built with this context includes, instead of parsing them each time
+    '''
+    self.pch = enable
+    self.changed()
+
+  def use_openmp(self, enable=True):
+    ''' Compiles with -fopenmp, links libgomp and includes omp.h
+    Every library shares one OpenMP runtime, whose threads sleep rather than
+    spin while waiting for work (OMP_WAIT_POLICY=PASSIVE) unless the
+    environment says otherwise, so threads of several libraries or of
+    parallel_for do not compete with spinning OpenMP threads. Libraries
+    built with OpenMP can set the number of threads, see
+    CPPLib.set_num_threads.
+    '''
+    self.openmp = enable
+    if enable:
+      os.environ.setdefault('OMP_WAIT_POLICY', 'PASSIVE')
+      if '#include <omp.h>' not in self.macros:
+        self.macros.append('#include <omp.h>')
+    self.changed()
+
+  def compile_flags(self):
+    ''' The flags passed to the compiler, flags and those of options '''
+    if self.openmp:
+      return self.flags + ['fopenmp']
+    return self.flags[:]
+
+  def link_libs(self):
+    ''' The libraries linked, links and those of options '''
+    if self.openmp:
+      return self.links + ['gomp']
+    return self.links[:]
+
+  def prelude(self):
+    ''' Returns the source code which comes before any function, the macros
+    or an include of their precompiled header
+    '''
+    if not self.pch:
+      return '\n'.join(self.macros)
+    header = cmake.precompile_header('\n'.join(self.macros), cc=self.cc,
+        flags=self.compile_flags(), includes=self.includes, defs=self.defs)
+    return '#include "%s"' % header
+
+  def changed(self):
+    ''' Invalidates inline bodies compiled under this context
+    The add_* methods call this, it only needs to be called after modifying
+    one of the lists (eg. flags) directly.
+    '''
+    self.version += 1
 
   def __hash__(self):
     return hash((repr(self.obj_files), repr(self.cc), repr(self.flags),
         repr(self.includes), repr(self.links), repr(self.defs), 
-        repr(self.macros), repr(self.name_spaces)))
+        repr(self.macros), repr(self.name_spaces), self.openmp))
 
 
 class CPPLib(object):
-  def __init__(self, lib, fin):
+  def __init__(self, lib, fin, sigs={}, hold_gil=False):
+    ''' 
+    \param lib the loaded library
+    \param fin function to call to delete the library
+    \param sigs dict of function name to (rtype, args) from decl_func
+    \param hold_gil if True, functions are called without releasing the GIL
+    '''
     self.fin = fin
-    self.lib = lib
+    self.hold_gil = hold_gil
+    self.lib = cmake.hold_gil(lib) if hold_gil else lib
+    self.sigs = dict(sigs)
+    self.wrappers = {}
+    self.natives = {}
+
+  def function(self, fnname):
+    ''' Gets the ctypes function for fnname, called with positional arguments
+    Functions declared with decl_func have argtypes and restype set, and take
+    their arguments in the order of the C++ declaration (sorted by name).
+    The function is also available as an attribute, E.g. CPPLib(...).foo(5, 7)
+    '''
+    fn = self._native(fnname)
+    if fnname not in self.sigs:
+      return fn
+    if instrument.ENABLED:
+      return instrument.timed(fnname, fn)
+    # later lookups of lib.fnname find the function without calling __getattr__
+    self.__dict__.setdefault(fnname, fn)
+    return fn
+
+  def __getattr__(self, fnname):
+    if fnname.startswith('__') or fnname not in self.__dict__.get('sigs', ()):
+      raise AttributeError(fnname)
+    return self.function(fnname)
 
   def __getitem__(self, fnname):
     ''' Gets the given function by name, invoked with keyword arguments
     E.g. CPPLilb(...)['foo'](x=5, y=7)
     '''
+    if instrument.ENABLED:
+      native = instrument.Timed(self._native(fnname))
+      return instrument.timed_wrapper(fnname, 
+          self._keyword_wrapper(fnname, native), native)
+    if fnname not in self.wrappers:
+      self.wrappers[fnname] = self._keyword_wrapper(fnname, 
+          self._native(fnname))
+    return self.wrappers[fnname]
+
+  def _native(self, fnname):
+    ''' The ctypes function, bound to its signature if it was declared '''
+    if fnname not in self.sigs:
+      return getattr(self.lib, fnname)
+    if fnname not in self.natives:
+      rtype, args = self.sigs[fnname]
+      self.natives[fnname] = cmake.bind_function(self.lib, fnname, rtype, args)
+    return self.natives[fnname]
+
+  def _keyword_wrapper(self, fnname, fn):
+    ''' Returns a function taking keyword arguments, which calls fn '''
+    if fnname not in self.sigs:
+      def wrap(**args):
+        # have to sort since we pass by keyword (which is ordered by hash)
+        vals = [v for k, v in cppinl.order_args(args)]
+        return cmake.invoke_function(fn, *vals)
+      return wrap
+    order = [k for k, v in cppinl.order_args(self.sigs[fnname][1])]
     def wrap(**args):
-
-      # have to sort since we pass by keyword (which is ordered by hash)
-      vals = [v for k, v in cppinl.order_args(args)]
-      return cmake.invoke_function(self.lib.__getattr__(fnname), *vals)
+      if len(args) != len(order):
+        raise TypeError('%s() takes %d arguments (%d given)' % (fnname, 
+            len(order), len(args)))
+      try:
+        vals = [args[k] for k in order]
+      except KeyError:
+        unexpected = sorted(set(args) - set(order))
+        missing = sorted(set(order) - set(args))
+        raise TypeError('%s() got unexpected arguments %s, missing %s' % (
+            fnname, ', '.join(unexpected), ', '.join(missing)))
+      try:
+        return fn(*vals)
+      except ctypes.ArgumentError, e:
+        # eg. an array which can not be passed as a pointer
+        raise TypeError('%s(): %s' % (fnname, e))
+      except:
+        print 'Call into C++ failed.'
+        print 'Arguments: ', ', '.join(map(repr, vals))
+        raise
     return wrap
 
+  # omp_sched_t values of omp.h
+  SCHEDULES = {'static' : 1, 'dynamic' : 2, 'guided' : 3, 'auto' : 4}
+
+  def _omp(self, fnname):
+    try:
+      return getattr(self.lib, fnname)
+    except AttributeError:
+      raise AttributeError('%s: the library is not built with OpenMP' % fnname)
+
+  def set_num_threads(self, n):
+    ''' Sets the number of threads of OpenMP parallel regions
+    The setting applies to regions run from the calling python thread, and
+    is shared by every library built with OpenMP.
+    '''
+    self._omp('omp_set_num_threads')(int(n))
+
+  def get_num_threads(self):
+    ''' Returns the number of threads an OpenMP parallel region will use '''
+    return self._omp('omp_get_max_threads')()
+
+  def set_schedule(self, kind, chunk=0):
+    ''' Sets the schedule of loops with schedule(runtime)
+    \param kind one of 'static', 'dynamic', 'guided', 'auto'
+    \param chunk the chunk size, 0 for the default
+    '''
+    self._omp('omp_set_schedule')(self.SCHEDULES[kind], int(chunk))
+
+  def swap(self, lib, fin):
+    ''' Replaces the library, eg. with a rebuild of the same source
+    Functions fetched from this CPPLib afterwards call into the new library.
+    '''
+    old_fin = self.fin
+    for fnname in self.natives:
+      self.__dict__.pop(fnname, None)
+    self.lib = cmake.hold_gil(lib) if self.hold_gil else lib
+    self.fin = fin
+    self.wrappers = {}
+    self.natives = {}
+    old_fin()
+
   def __del__(self):
     ''' Clean up shared object files in /tmp
     '''
     self.fin()
 
 class CPPLibBuilder(object):
-  def __init__(self, ctx):
+  def __init__(self, ctx, defer=False, hold_gil=False):
+    ''' 
+    \param ctx the Context to compile with
+    \param defer if True, inline bodies are collected and compiled together
+        into one library when one of them is first called, or on flush()
+    \param hold_gil if True, the functions of libraries and inline bodies are
+        called without releasing the GIL, which is faster for tiny functions
+        but stops other threads while they run
+    '''
     self.context = ctx
     self.src = []
     self.raw = []
     self.fins = []
     self.inlines = {}
+    self.sigs = {}
+    self.defer = defer
+    # declarations included before the code of every translation unit
+    self.decls = []
+    # inline bodies waiting for flush(), key -> (name, body, args)
+    self.pending = {}
+    self.inline_count = 0
+    self.hold_gil = hold_gil
+    # guards inlines, pending, building and failed, but is not held while
+    # compiling
+    self.lock = threading.Lock()
+    # events of inline bodies being compiled, other threads wait on them
+    self.building = {}
+    # exc_info of queued bodies which failed to compile, raised to the next
+    # caller of the body
+    self.failed = {}
 
   def raw_source(self, txt):
     self.src.append(txt)
 
+  def declare(self, txt):
+    ''' Adds declarations (eg. prototypes of raw_source helpers) which come
+    before all other code, and are repeated in every object of make(split=True)
+    '''
+    self.decls.append(txt)
+
+  def use_struct(self, struct):
+    ''' Declares the C++ struct of a structs.Struct, see declare() '''
+    decl = struct.declaration()
+    if decl not in self.decls:
+      self.declare(decl)
+
   def set_context(self, ctx):
     self.context = ctx
 
@@ -92,73 +317,323 @@ class CPPLibBuilder(object):
 
   def decl_func(self, name, body, rtype=None, **args):
     self.src.append(cppinl.cpp_func_def_convert(name, body, rtype, **args))
+    self.sigs[name] = (rtype, args)
 
   def inline_source(self, body, **args):
-    decl = cppinl.cpp_func_def_convert('temp2e5e3662020b4edea3ab3a5598010207', 
-        body, None, **args)
+    decl = cppinl.cpp_func_def_convert(INLINE_NAME, body, None, **args)
     src = self.emit_source(lines=[decl])
     return src
 
   def inline_call(self, body, **args):
-    ctxh = hash(self.context)
-    bodyh = hash(body)
+    fn, order = self._inline_entry(body, args)
+    if instrument.ENABLED:
+      fn = instrument.timed(instrument.inline_name(body), fn)
+    try:
+      vals = [args[k] for k in order]
+      fn(*vals)
+    except:
+      print 'Call into C++ failed.'
+      print 'Arguments: ', ', '.join(map(repr, args.values()))
+      raise
+
+  def inline(self, body, **args):
+    ''' Compiles an inline body and returns an InlineFunc to call it
+    Arguments are given as types or example values, like decl_func. Calling 
+    the InlineFunc is the same as calling inline_call without looking the 
+    body up each time. If the builder defers inline bodies, compiling waits
+    until the first call or flush().
+    '''
+    return InlineFunc(self, body, args)
 
-    ke = (ctxh, bodyh)
-    if ke not in self.inlines:
-      lib, fin = self._make_inline_call(body, **args)
-      self.fins.append(fin)
-      self.inlines[ke] = lib
+  def _inline_key(self, body, args):
+    ctx = self.context
+    return (ctx.uid, ctx.version, body, cppinl.signature_key(args))
 
-    # have to sort since we pass by keyword (which is ordered by hash)
-    vals = [v for k, v in cppinl.order_args(args)]
-    cmake.invoke_function(self.inlines[ke].temp2e5e3662020b4edea3ab3a5598010207, 
-        *vals)
+  def _inline_entry(self, body, args):
+    ''' Returns (fn, order) for an inline body, compiling it if needed
+    fn is the bound C++ function and order the names of its arguments. If
+    another thread is compiling the body, waits for it instead.
+    '''
+    hit = True
+    while True:
+      ke = self._inline_key(body, args)
+      with self.lock:
+        entry = self.inlines.get(ke)
+        event = self.building.get(ke)
+        failed = None
+        if entry is None and event is None:
+          failed = self.failed.pop(ke, None)
+        if entry is None and event is None and not self.defer:
+          event = self.building[ke] = threading.Event()
+          mine = True
+        else:
+          mine = False
+      if failed is not None:
+        raise failed[0], failed[1], failed[2]
+      if entry is not None:
+        if instrument.ENABLED:
+          instrument.record_inline(hit, body)
+        return entry
+      hit = False
+      if event is not None and not mine:
+        # compiled by another thread, look again once it is done
+        event.wait()
+      elif self.defer:
+        self._register_inline(body, args)
+        self.flush()
+      else:
+        try:
+          lib, fin = self._make_inline_call(body, **args)
+          self._add_inline(ke, lib, fin, INLINE_NAME, args)
+        finally:
+          with self.lock:
+            del self.building[ke]
+          event.set()
+
+  def _add_inline(self, ke, lib, fin, name, args):
+    ''' Binds an inline body compiled as name in lib '''
+    if self.hold_gil:
+      lib = cmake.hold_gil(lib)
+    fn = cmake.bind_function(lib, name, None, args)
+    with self.lock:
+      if fin is not None:
+        self.fins.append(fin)
+      self.inlines[ke] = (fn, [k for k, v in cppinl.order_args(args)])
+
+  def _register_inline(self, body, args):
+    ''' Queues an inline body for the next flush() '''
+    ke = self._inline_key(body, args)
+    with self.lock:
+      if ke not in self.inlines and ke not in self.pending \
+          and ke not in self.building:
+        self.pending[ke] = ('pycpc_inline_%d' % self.inline_count, body, args)
+        self.inline_count += 1
+
+  def flush(self):
+    ''' Compiles every queued inline body into a single library
+    Bodies queued under an older version of the context are dropped, they
+    are queued again when called. If the library fails to compile, each
+    body is compiled on its own so the error names the body at fault, and
+    is raised when that body is called, the others are still compiled.
+    '''
+    ctx = self.context
+    with self.lock:
+      pending, self.pending = self.pending, {}
+      pending = dict((ke, v) for ke, v in pending.items() 
+          if ke[:2] == (ctx.uid, ctx.version))
+      events = dict((ke, threading.Event()) for ke in pending)
+      self.building.update(events)
+    if not pending:
+      return
+    try:
+      decls = [cppinl.cpp_func_def_convert(name, body, None, **args) 
+          for name, body, args in pending.values()]
+      src = self.emit_source(lines=decls, prelude=ctx.prelude())
+      try:
+        lib, fin = self._make(src=src)
+      except cmake.CompileError:
+        for ke, (name, body, args) in pending.items():
+          try:
+            lib, fin = self._make_inline_call(body, **args)
+          except cmake.CompileError:
+            with self.lock:
+              self.failed[ke] = sys.exc_info()
+            continue
+          self._add_inline(ke, lib, fin, INLINE_NAME, args)
+        return
+      self.fins.append(fin)
+      for ke, (name, body, args) in pending.items():
+        self._add_inline(ke, lib, None, name, args)
+    finally:
+      with self.lock:
+        for ke in events:
+          del self.building[ke]
+      for event in events.values():
+        event.set()
 
   def _make_inline_call(self, body, **args):
     # using a uuid for the function name, hopefully avoids conflicts
-    decl = cppinl.cpp_func_def_convert('temp2e5e3662020b4edea3ab3a5598010207', 
-        body, None, **args)
-    src = self.emit_source(lines=[decl])
+    decl = cppinl.cpp_func_def_convert(INLINE_NAME, body, None, **args)
+    src = self.emit_source(lines=[decl], prelude=self.context.prelude())
     lib, fin = self._make(src=src)
     return lib, fin
 
-  def emit_source(self, lines=None):
+  def emit_source(self, lines=None, prelude=None):
     ''' Returns C++ source code that will be compiled when make() is called
+    \param prelude replaces the macros of the context
     '''
     if lines is None:
       lines = self.src
+    if prelude is None:
+      prelude = '\n'.join(self.context.macros)
     src = '\n'.join(lines)
-    src = '\n'.join(self.context.macros) + '\n\n' \
-        + '\n'.join(self.context.name_spaces) + '\n\n' + src
+    src = prelude + '\n\n' \
+        + '\n'.join(self.context.name_spaces) + '\n\n' \
+        + ''.join(d + '\n' for d in self.decls) + src
     return src
 
-  def make(self, src=None):
+  def make(self, src=None, split=False):
     ''' Compiles the soruce and returns a CPPLib to call into the object file
+    \param split if True, each raw_source and decl_func is compiled into its
+        own object, which is reused until its code changes. Code calling 
+        functions of another raw_source needs their prototypes from declare().
     '''
-    lib, fin = self._make(src=src)
-    return CPPLib(lib, fin)
+    if split and src is None:
+      prelude = self.context.prelude()
+      lib, fin = cmake.compile_and_load_sources(
+          [self.emit_source(lines=[line], prelude=prelude) for line in self.src],
+          **self._build_opts())
+    else:
+      lib, fin = self._make(src=src)
+    return CPPLib(lib, fin, self.sigs, self.hold_gil)
+
+  def make_for(self, ctx, src=None):
+    ''' Like make(), but compiles with another context (eg. a variant of
+    this builder's context with other flags)
+    '''
+    if src is None:
+      src = self.emit_source(prelude=ctx.prelude())
+    lib, fin = cmake.compile_and_load_source(src, **self._build_opts(ctx))
+    self.fins.append(fin)
+    return CPPLib(lib, lambda: None, self.sigs, self.hold_gil)
+
+  def build_for(self, ctx, src=None):
+    ''' Compiles like make_for() into the compilation cache, without loading
+    the library, see cmake.build_source
+    '''
+    if src is None:
+      src = self.emit_source(prelude=ctx.prelude())
+    return cmake.build_source(src, **self._build_opts(ctx))
+
+  def make_pgo(self, train, src=None):
+    ''' Compiles with profile guided optimization, returns a CPPLib
+    The library is first built with instrumentation and train(lib) is
+    called with its CPPLib, which should call the hot functions with
+    typical inputs. Then the library is rebuilt using the recorded profile
+    and swapped into the same CPPLib. The profile and the optimized library
+    are cached, later builds of the same source load it without training.
+    '''
+    if src is None:
+      src = self.emit_source(prelude=self.context.prelude())
+    trained = []
+    def run(lib, fin):
+      trained.append(CPPLib(lib, fin, self.sigs, self.hold_gil))
+      train(trained[0])
+    lib, fin = cmake.compile_and_load_pgo(src, run, **self._build_opts())
+    if not trained:
+      return CPPLib(lib, fin, self.sigs, self.hold_gil)
+    trained[0].swap(lib, fin)
+    return trained[0]
+
+  def make_async(self, src=None, timeout=None):
+    ''' Like make(), but compiles in the background
+    Returns a pool.Future whose result() is the CPPLib, cancel() kills the
+    compiler. Use add_done_callback on the future to be notified without
+    blocking (eg. from an event loop).
+    \param timeout seconds each compiler process may run
+    '''
+    return cmake.submit(self.make, kwargs=dict(src=src), timeout=timeout)
 
   def _make(self, src=None):
     ''' Compiles source code and links with the shared object 
     Returns a handle for the library and a function hook to delete the .so
     '''
     if src is None:
-      src = self.emit_source()
-    lib, fin = cmake.compile_and_load_source(src,
-        obj_files=self.context.obj_files,
-        cc=self.context.cc,
-        flags=self.context.flags,
-        includes=self.context.includes,
-        links=self.context.links,
-        defs=self.context.defs)
+      src = self.emit_source(prelude=self.context.prelude())
+    lib, fin = cmake.compile_and_load_source(src, **self._build_opts())
     return lib, fin
 
+  def _build_opts(self, ctx=None):
+    ''' Compiler options of the context, as arguments for cmake '''
+    if ctx is None:
+      ctx = self.context
+    return dict(obj_files=ctx.obj_files,
+        cc=ctx.cc,
+        flags=ctx.compile_flags(),
+        includes=ctx.includes,
+        links=ctx.link_libs(),
+        defs=ctx.defs)
+
+  def is_cached(self, src=None):
+    ''' Returns True if make() will load a cached library without compiling
+    '''
+    if not cache.ENABLED:
+      return False
+    if src is None:
+      src = self.emit_source(prelude=self.context.prelude())
+    key = cache.build_key(src, **self._build_opts())
+    return cache.lookup(key) is not None
+
   def __del__(self):
     """ Clean up temporary shared object files """
     for fin in self.fins:
       fin()
 
 
+class InlineFunc(object):
+  ''' A compiled inline body, see CPPLibBuilder.inline
+  Call with keyword arguments, or positionally in the order of the C++
+  declaration (sorted by name). The body is recompiled if the builder's
+  context changes.
+  '''
+  def __init__(self, builder, body, args):
+    self.builder = builder
+    self.body = body
+    self.args = args
+    self.order = [k for k, v in cppinl.order_args(args)]
+    self.context = builder.context
+    self.version = self.context.version
+    self.fn = None
+    if builder.defer:
+      builder._register_inline(body, args)
+    else:
+      self._bind()
+
+  def _bind(self):
+    self.context = self.builder.context
+    self.version = self.context.version
+    self.fn, self.order = self.builder._inline_entry(self.body, self.args)
+
+  def __call__(self, *vals, **args):
+    if self.fn is None or self.builder.context is not self.context \
+        or self.context.version != self.version:
+      self._bind()
+    if args:
+      vals = [args[k] for k in self.order]
+    if instrument.ENABLED:
+      return instrument.timed(instrument.inline_name(self.body), self.fn)(*vals)
+    return self.fn(*vals)
+
+
+def compile_many(units, jobs=None):
+  ''' Compiles many libraries and inline bodies concurrently
+  Each unit is either a CPPLibBuilder, which is compiled with make(), or a 
+  tuple (builder, body, args) naming an inline body and a dict of its
+  arguments, which is compiled so later inline_call(body, **args) calls do not
+  need to compile.
+  \param units list of builders and (builder, body, args) tuples
+  \param jobs number of compiler processes to run at once (default: one per CPU)
+  \return a list with an entry per unit: the CPPLib for a builder, an
+      InlineFunc for an inline body, or the exception raised compiling the unit
+  '''
+  def build(unit):
+    if isinstance(unit, CPPLibBuilder):
+      return unit.make()
+    lbuild, body, args = unit
+    return lbuild.inline(body, **args)
+
+  workers = pool.WorkerPool(jobs)
+  try:
+    futures = workers.map(build, units)
+    results = []
+    for fut in futures:
+      exc = fut.exception()
+      results.append(exc if exc is not None else fut.result())
+    return results
+  finally:
+    workers.shutdown()
+
+
 if __name__ == '__main__':
   ctx = Context()
   ctx.add_basic_libs()
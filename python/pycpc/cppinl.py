@@ -1,3 +1,4 @@
+import array
 import ctypes
 
 """
@@ -9,6 +10,26 @@ def order_args(args):
   return sorted(a, key=lambda i:i[0].replace('__PYCPC__', ''))
 
 
+def signature_key(args):
+  ''' Returns a hashable key of argument names and the C++ types they map to
+  >>> signature_key(dict(x=5)) == signature_key(dict(x=7))
+  True
+  >>> signature_key(dict(x=5)) == signature_key(dict(x=7.0))
+  False
+  >>> signature_key(dict(x=5.0)) == signature_key(dict(x=float))
+  True
+  '''
+  def typ(v):
+    if isinstance(v, CHandle):
+      return (v.cpp_type(), v.cast)
+    if isinstance(v, type):
+      return v
+    if type(v) not in _plain_types and buffer_format(v) is not None:
+      return (as_handle(v).cpp_type(), None)
+    return type(v)
+  return frozenset([(k, typ(v)) for k, v in args.iteritems()])
+
+
 def cpp_func_decl(name, args, rtype=None):
   """ Creates C++ source code for a function declaration
   >>> cpp_func_decl('foobar', [('x', long)], long)
@@ -34,9 +55,11 @@ def cpp_func_def_convert(name, body, rtype=None, **args):
   >>> cpp_func_def_convert('foo', 'x = new int64_t[2];', None, x=CHandle(long))
   'extern "C" void foo(int64_t** __x__) {\\nint64_t* &x = *__x__;\\nx = new int64_t[2];\\n}'
   '''
-  mangled_args = []
   remap_code = []
   for arg, val in order_args(args):
+    if as_handle(val) is not None:
+      # arrays are passed as handles
+      val = as_handle(val)
     # mange if val is a Handle
     if isinstance(val, CHandle):
       if val.cast is None:
@@ -44,14 +67,31 @@ def cpp_func_def_convert(name, body, rtype=None, **args):
       else:
         remap_code.append('%s &%s = * ((%s**) __PYCPC__%s);' % (val.deref_type(), 
            arg, val.cast,arg))
-      mangled_args.append(('__PYCPC__%s'%arg, val))
-    else:
-      mangled_args.append((arg, val))
+  mangled_args = mangle_args(args)
   remap_code.append(body)
   body = '\n'.join(remap_code)
   return cpp_func_def(name, mangled_args, body, rtype=rtype)
 
 
+def mangle_args(args):
+  ''' Returns the (name, value) parameters of a function defined with
+  cpp_func_def_convert, in order. Handles are renamed since the body
+  refers to them through a reference.
+  >>> mangle_args(dict(y=5, x=CHandle(long)))[0][0]
+  '__PYCPC__x'
+  '''
+  mangled_args = []
+  for arg, val in order_args(args):
+    if as_handle(val) is not None:
+      # arrays are passed as handles
+      val = as_handle(val)
+    if isinstance(val, CHandle):
+      mangled_args.append(('__PYCPC__%s'%arg, val))
+    else:
+      mangled_args.append((arg, val))
+  return mangled_args
+
+
 def get_cpp_type(foo):
   ''' Converts a tpye or object to a string with the C++ type
   >>> get_cpp_type(long)
@@ -66,24 +106,22 @@ def get_cpp_type(foo):
   'double**'
   >>> get_cpp_type(ctypes.c_double(5))
   'double'
+  >>> get_cpp_type(ctypes.c_uint8)
+  'uint8_t'
+  >>> get_cpp_type(CHandle(ctypes.c_float))
+  'float**'
   '''
   if isinstance(foo, CHandle):
     return foo.cpp_type()
+  if as_handle(foo) is not None:
+    return as_handle(foo).cpp_type()
 
-  if type(foo) is not type:
+  if not isinstance(foo, type):
     foo = type(foo)
   if foo is type(None):
     return 'void'
-  if foo is ctypes.c_longlong:
-    return 'int64_t'
-  if foo is ctypes.c_int:
-    return 'int32_t'
-  if foo is ctypes.c_char_p: 
-    return 'char*'
-  if foo is ctypes.c_double:
-    return 'double'
-  if foo is ctypes.c_void_p:
-    return 'void*'
+  if foo in _ctype_names:
+    return _ctype_names[foo]
   prims = {int : 'int32_t', long : 'int64_t', str : 'char*', float : 'double'}
 
   if foo in prims:
@@ -91,11 +129,151 @@ def get_cpp_type(foo):
   raise Exception('Cannot resolev type: %s' % foo)
 
 
+# C++ names of the ctypes types (c_long and others are aliases of these)
+_ctype_names = {ctypes.c_char_p : 'char*', ctypes.c_void_p : 'void*',
+    ctypes.c_float : 'float', ctypes.c_double : 'double'}
+for _bits in (8, 16, 32, 64):
+  _ctype_names[getattr(ctypes, 'c_int%d' % _bits)] = 'int%d_t' % _bits
+  _ctype_names[getattr(ctypes, 'c_uint%d' % _bits)] = 'uint%d_t' % _bits
+
+
 def get_ctype(foo):
+  if foo in _ctype_names:
+    return foo
   prims = {int : ctypes.c_int, long : ctypes.c_longlong, str : ctypes.c_char_p, 
       float : ctypes.c_double, None : ctypes.c_void_p}
   return prims[foo]
 
+
+def get_argtype(foo):
+  ''' Converts a type or object to the ctypes type used in argtypes
+  Handles are passed as untyped pointers, so any handle may be passed.
+  >>> get_argtype(long) is ctypes.c_longlong
+  True
+  >>> get_argtype(5.0) is ctypes.c_double
+  True
+  >>> get_argtype(CHandle(long)) is HandleArg
+  True
+  '''
+  if isinstance(foo, CHandle) or as_handle(foo) is not None:
+    return HandleArg
+  if not isinstance(foo, type):
+    foo = type(foo)
+  if issubclass(foo, ctypes._SimpleCData):
+    return foo
+  return get_ctype(foo)
+
+
+def get_restype(rtype):
+  ''' Converts a return type to the ctypes type used as restype
+  >>> get_restype(None)
+  >>> get_restype(long) is ctypes.c_longlong
+  True
+  >>> get_restype(float) is ctypes.c_double
+  True
+  '''
+  if rtype is None or rtype is type(None):
+    return None
+  return get_argtype(rtype)
+
+
+_plain_types = (int, long, float, str, type(None))
+
+# element formats of buffers which can be passed in place of a handle
+BUFFER_TYPES = {'f8' : float, 'i8' : long, 'i4' : int, 'f4' : ctypes.c_float}
+for _bits in (8, 16, 32, 64):
+  BUFFER_TYPES.setdefault('i%d' % (_bits // 8), getattr(ctypes, 'c_int%d' % _bits))
+  BUFFER_TYPES['u%d' % (_bits // 8)] = getattr(ctypes, 'c_uint%d' % _bits)
+
+
+def buffer_format(obj):
+  ''' Returns the element format of an array, eg. 'f8' for doubles, or None
+  Arrays are array.array objects and objects with an __array_interface__ 
+  such as NumPy arrays.
+  >>> buffer_format(array.array('d'))
+  'f8'
+  >>> buffer_format([1.0])
+  '''
+  if isinstance(obj, array.array):
+    if obj.typecode in 'fd':
+      kind = 'f'
+    elif obj.typecode in 'BHILc':
+      kind = 'u'
+    else:
+      kind = 'i'
+    return '%s%d' % (kind, obj.itemsize)
+  iface = getattr(obj, '__array_interface__', None)
+  if iface is not None:
+    # drop the byte order, eg. '<f8'
+    return iface['typestr'][1:]
+  return None
+
+
+def buffer_address(obj):
+  ''' Returns the address of the first element of an array '''
+  if isinstance(obj, array.array):
+    return obj.buffer_info()[0]
+  return obj.__array_interface__['data'][0]
+
+
+def check_pointer(obj):
+  ''' Raises TypeError unless an array's memory can be passed as a `T*`
+  The elements must be contiguous, and the memory writable since C++ may
+  write through the pointer.
+  >>> check_pointer(array.array('d', [1.0]))
+  '''
+  iface = getattr(obj, '__array_interface__', None)
+  if iface is None:
+    return
+  if iface['data'][1]:
+    raise TypeError('cannot pass a read-only array as a pointer, copy it '
+        'first')
+  strides = iface.get('strides')
+  if strides is None:
+    return
+  # the strides of a C-contiguous array of the same shape
+  step = int(iface['typestr'][2:])
+  for dim, stride in reversed(zip(iface['shape'], strides)):
+    if dim > 1 and stride != step:
+      raise TypeError('cannot pass a non-contiguous array as a pointer, copy '
+          'it first (eg. numpy.ascontiguousarray)')
+    step *= dim
+
+
+def as_handle(obj):
+  ''' Returns a CHandle describing the type of an array passed as a pointer
+  Returns handles as they are and None for anything which is not an array.
+  >>> as_handle(array.array('d'))
+  CHandle(typ=<type 'float'>, cast=None)
+  '''
+  if isinstance(obj, CHandle):
+    return obj
+  fmt = buffer_format(obj)
+  if fmt is None:
+    return None
+  if fmt not in BUFFER_TYPES:
+    raise Exception('Cannot pass an array of %s as a pointer' % fmt)
+  check_pointer(obj)
+  return CHandle(BUFFER_TYPES[fmt])
+
+
+class HandleArg(object):
+  ''' The ctypes argument type of handle parameters
+  Accepts a CHandle, or an array (see buffer_format) whose memory is passed
+  without copying. For an array, C++ gets a reference to a temporary pointer,
+  so assigning to it (eg. `x = new double[2];`) is not seen by python.
+  '''
+  @classmethod
+  def from_param(cls, obj):
+    if isinstance(obj, CHandle):
+      return obj._as_parameter_
+    if obj is None:
+      return None
+    if buffer_format(obj) is None:
+      raise TypeError('expected a CHandle or an array, got %s' % type(obj))
+    check_pointer(obj)
+    return ctypes.pointer(ctypes.c_void_p(buffer_address(obj)))
+
 class CHandle(object):
   ''' This is a generic handle to memory, it's a C++ pointer.
   This serves multiple purposes:
@@ -134,7 +312,8 @@ class CHandle(object):
   '''
   def __init__(self, typ=None, cast=None):
     ''' Creates a new Handle, only typ or cast should be set, not both
-    Valid types are: long, int, float
+    Valid types are: long, int, float and the fixed size ctypes integer and
+    floating point types (eg. ctypes.c_uint8, ctypes.c_float)
 
     The field cast can be any string which is a valid C++ type.
     '''
@@ -215,6 +394,11 @@ class CHandle(object):
     #self.ptr[0][idx].value = v
     self.ptr[0][idx] = v
 
+  @property
+  def _as_parameter_(self):
+    ''' Lets ctypes pass a handle directly as a T** argument '''
+    return self.ptr
+
   def __str__(self):
     return 'CHandle:%s' % self.cpp_type()
 
@@ -0,0 +1,156 @@
+import os
+import threading
+import timeit
+
+"""
+Opt-in statistics of compiling and calling C++ code
+
+When enabled (with enable() or PYCPC_STATS=1) pycpc records
+  stats['compile']    count, seconds, cache hits and misses, bytes of .so files
+  stats['inline']     hits and misses of the inline_call cache
+  stats['functions']  for each function name: calls, seconds spent in the
+                      native function ('native') and preparing its arguments
+                      in python ('marshal')
+Hooks added with add_hook are called as hook(event, info) for each record,
+where event is 'compile', 'inline' or 'call' and info a dict. When disabled,
+the cost is a test of ENABLED.
+
+Functions are timed when looked up while enabled, a function fetched from a
+CPPLib as an attribute beforehand stays untimed.
+"""
+
+ENABLED = os.environ.get('PYCPC_STATS', '0') != '0'
+
+now = timeit.default_timer
+
+stats = {}
+_hooks = []
+_lock = threading.Lock()
+
+
+def enable():
+  global ENABLED
+  ENABLED = True
+
+
+def disable():
+  global ENABLED
+  ENABLED = False
+
+
+def reset():
+  ''' Clears the statistics '''
+  with _lock:
+    stats.clear()
+    stats['compile'] = dict(count=0, seconds=0.0, hits=0, misses=0, bytes=0)
+    stats['inline'] = dict(hits=0, misses=0)
+    stats['functions'] = {}
+
+reset()
+
+
+def add_hook(fn):
+  ''' Calls fn(event, info) for everything recorded '''
+  _hooks.append(fn)
+
+
+def remove_hook(fn):
+  _hooks.remove(fn)
+
+
+def _notify(event, info):
+  for hook in _hooks:
+    hook(event, info)
+
+
+def record_compile(seconds, hit, path):
+  ''' Records building (or loading from the cache) the library at path '''
+  size = os.path.getsize(path) if os.path.exists(path) else 0
+  with _lock:
+    c = stats['compile']
+    c['count'] += 1
+    c['seconds'] += seconds
+    c['hits' if hit else 'misses'] += 1
+    c['bytes'] += size
+  _notify('compile', dict(seconds=seconds, hit=hit, path=path, bytes=size))
+
+
+def record_inline(hit, body):
+  ''' Records a lookup of an inline body in a builder '''
+  with _lock:
+    stats['inline']['hits' if hit else 'misses'] += 1
+  _notify('inline', dict(hit=hit, body=body))
+
+
+def record_call(name, native, marshal=0.0):
+  with _lock:
+    f = stats['functions'].get(name)
+    if f is None:
+      f = stats['functions'][name] = dict(calls=0, native=0.0, marshal=0.0)
+    f['calls'] += 1
+    f['native'] += native
+    f['marshal'] += marshal
+  _notify('call', dict(name=name, native=native, marshal=marshal))
+
+
+def inline_name(body):
+  ''' The name inline bodies are recorded under, their first line '''
+  lines = [l.strip() for l in body.strip().splitlines()] or ['']
+  return 'inline: ' + lines[0][:40]
+
+
+class Timed(object):
+  ''' Calls fn, remembering the seconds taken by the last call '''
+  def __init__(self, fn):
+    self.fn = fn
+    self.seconds = 0.0
+
+  def __call__(self, *vals):
+    start = now()
+    try:
+      return self.fn(*vals)
+    finally:
+      self.seconds = now() - start
+
+
+def timed(name, fn):
+  ''' Returns fn, recording the time of each call as native time of name '''
+  def call(*vals):
+    start = now()
+    try:
+      return fn(*vals)
+    finally:
+      record_call(name, now() - start)
+  return call
+
+
+def timed_wrapper(name, wrap, native):
+  ''' Returns wrap, recording the time of each call of name
+  \param wrap function preparing arguments and calling native
+  \param native the Timed function wrap calls, time outside of it is
+      recorded as marshalling
+  '''
+  def call(*vals, **args):
+    start = now()
+    try:
+      return wrap(*vals, **args)
+    finally:
+      total = now() - start
+      record_call(name, native.seconds, total - native.seconds)
+  return call
+
+
+def report():
+  ''' Returns the statistics as text, functions by native time '''
+  with _lock:
+    c = dict(stats['compile'])
+    i = dict(stats['inline'])
+    funcs = sorted(stats['functions'].items(),
+        key=lambda item: -item[1]['native'])
+  lines = ['compiled %d (%d cached) in %.3fs, %d bytes' % (c['count'],
+      c['hits'], c['seconds'], c['bytes']),
+      'inline cache %d hits, %d misses' % (i['hits'], i['misses'])]
+  for name, f in funcs:
+    lines.append('%-40s %8d calls  native %.6fs  marshal %.6fs' % (name,
+        f['calls'], f['native'], f['marshal']))
+  return '\n'.join(lines)
@@ -0,0 +1,161 @@
+import os
+import platform
+import pool
+
+"""
+Builds of a library for several x86-64 ISA levels, choosing one at load
+
+Libraries compiled with -march=native are fastest, but cannot be shared (eg.
+through the cache on a network drive) with hosts lacking some of the
+instructions. make() compiles a library for each of the psABI levels
+  x86-64     the baseline, SSE2
+  x86-64-v2  SSE4.2, POPCNT
+  x86-64-v3  AVX2, FMA, BMI2
+  x86-64-v4  AVX-512
+and loads the best level the host supports. Each level has its own -march
+flag, so its own cache entry. Set PYCPC_ISA to a level to use it instead of
+the detected one.
+"""
+
+LEVELS = ['x86-64', 'x86-64-v2', 'x86-64-v3', 'x86-64-v4']
+
+# /proc/cpuinfo flags each level requires, in addition to those of the
+# levels before it
+_level_flags = {
+  'x86-64' : [],
+  'x86-64-v2' : ['cx16', 'lahf_lm', 'popcnt', 'sse4_1', 'sse4_2', 'ssse3'],
+  'x86-64-v3' : ['abm', 'avx', 'avx2', 'bmi1', 'bmi2', 'f16c', 'fma', 'movbe',
+      'xsave'],
+  'x86-64-v4' : ['avx512f', 'avx512bw', 'avx512cd', 'avx512dq', 'avx512vl'],
+}
+
+_cpu_flags = None
+
+
+def is_x86_64():
+  return platform.machine() in ('x86_64', 'AMD64')
+
+
+def default_levels():
+  ''' The levels make() builds, [None] (no -march flag) if not on x86-64 '''
+  if not is_x86_64():
+    return [None]
+  return list(LEVELS)
+
+
+def cpu_flags():
+  ''' Returns the set of feature flags of the host's CPU, from /proc/cpuinfo
+  Empty if they can not be read.
+  '''
+  global _cpu_flags
+  if _cpu_flags is None:
+    flags = set()
+    try:
+      with open('/proc/cpuinfo') as f:
+        for line in f:
+          if line.startswith('flags'):
+            flags = set(line.split(':', 1)[1].split())
+            break
+    except IOError:
+      pass
+    _cpu_flags = flags
+  return _cpu_flags
+
+
+def required_flags(level):
+  ''' Returns the CPU flags needed to run code built for a level
+  >>> 'avx2' in required_flags('x86-64-v3'), 'avx2' in required_flags('x86-64-v2')
+  (True, False)
+  '''
+  if level is None:
+    return set()
+  flags = set()
+  for l in LEVELS[:LEVELS.index(level) + 1]:
+    flags.update(_level_flags[l])
+  return flags
+
+
+def host_supports(level):
+  return required_flags(level) <= cpu_flags()
+
+
+def host_level(levels=None):
+  ''' Returns the highest of the levels the host can run, or PYCPC_ISA '''
+  if levels is None:
+    levels = default_levels()
+  forced = os.environ.get('PYCPC_ISA')
+  if forced:
+    return forced
+  usable = [l for l in levels if host_supports(l)]
+  if not usable:
+    return None
+  return max(usable, key=_rank)
+
+
+def _rank(level):
+  if level in LEVELS:
+    return LEVELS.index(level)
+  return -1
+
+
+def level_context(ctx, level):
+  ''' Returns a copy of a Context compiling for the level '''
+  ctx = ctx.clone()
+  if level is not None:
+    ctx.flags = [f for f in ctx.flags if not f.startswith('march=')]
+    ctx.flags.append('march=%s' % level)
+  return ctx
+
+
+def make(lbuild, levels=None, build_all=True, jobs=None):
+  ''' Compiles a builder's library for several levels and loads the best
+  Levels which fail to compile (eg. the compiler does not know them) are
+  skipped. Only the level loaded is loaded, code for levels the host lacks
+  is never run. The returned CPPLib has the level loaded in its isa
+  attribute.
+  \param lbuild a CPPLibBuilder
+  \param levels list of levels (default: all levels on x86-64)
+  \param build_all if False, only the level loaded is compiled (and lower ones
+      if it fails), otherwise all are compiled into the cache for other hosts
+      (when the cache is enabled)
+  \param jobs number of compiler processes to run at once
+  '''
+  if levels is None:
+    levels = default_levels()
+  levels = sorted(levels, key=_rank, reverse=True)
+  host = host_level(levels)
+
+  def build(level):
+    # compiles only, into the cache
+    try:
+      lbuild.build_for(level_context(lbuild.context, level))
+    except Exception, e:
+      return e
+
+  failed = {}
+  if build_all:
+    workers = pool.WorkerPool(jobs)
+    try:
+      failed = dict(zip(levels, [f.result() for f in 
+          workers.map(build, levels)]))
+    finally:
+      workers.shutdown()
+
+  error = None
+  for level in levels:
+    if _rank(level) > _rank(host):
+      continue
+    if failed.get(level) is not None:
+      error = failed[level]
+      continue
+    try:
+      lib = lbuild.make_for(level_context(lbuild.context, level))
+    except Exception, e:
+      error = e
+      continue
+    lib.isa = level
+    return lib
+  if error is None:
+    raise ValueError('the host supports none of %s' % 
+        ', '.join(map(str, levels)))
+  raise error
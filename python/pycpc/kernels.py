@@ -0,0 +1,527 @@
+import array
+import context
+import cppinl
+import ctypes
+import parallel
+import pool
+import re
+import threading
+import vectors
+
+"""
+Kernels generated from expressions over arrays
+
+elementwise() compiles a C++ statement into a loop over arrays:
+
+  fma = pycpc.elementwise('out = a * b + c', a=float, b=float, c=float,
+      out=float)
+  out = fma(a=va, b=vb, c=2.0)
+
+In the loop each name is one element of its array. Arguments are CVectors,
+array.array or NumPy arrays, and python numbers or arrays of length one
+which are broadcast to every element. Outputs which are not given are
+allocated as CVectors. Several outputs and statements can be computed in
+one pass (eg. 'lo = a < b ? a : b; hi = a < b ? b : a'), without temporary
+arrays between them.
+
+A loop is generated for each way of calling the kernel (which arguments are
+scalars and which arrays are strided), with __restrict pointers so the
+compiler vectorizes it without checking whether the arrays overlap.
+Outputs may be the inputs (computing in place) but must not overlap them
+otherwise.
+
+reduce() compiles an expression into a reduction of its values:
+
+  total = pycpc.reduce('a * b', combine='sum', a=float, b=float)
+  dot = total(a=va, b=vb)
+
+Arrays are cut into chunks which are reduced with several accumulators each
+(breaking the dependency of each step on the last, so the loop pipelines
+and vectorizes), on several threads. The results of the chunks are combined
+as a tree. Chunks do not depend on the number of threads, so a result is
+the same whichever number of threads computed it.
+"""
+
+# names assigned in an expression, eg. 'out' in 'out += a'
+_assigned = re.compile(r'\b([A-Za-z_]\w*)\s*(?:[-+*/%&|^]|<<|>>)?=(?!=)')
+
+
+def _cpp(dtype):
+  return cppinl.get_cpp_type(vectors.DTYPES[vectors.dtype_name(dtype)])
+
+
+def _element_lines(types, outputs, kinds, index='pycpc_i'):
+  ''' Returns the C++ lines binding each array's name to its element
+  >>> _element_lines(dict(x=long), [], dict(x='strided'), 'pycpc_i + 1')
+  ['const int64_t x = pycpc_x[(pycpc_i + 1) * pycpc_x_stride];']
+  '''
+  lines = []
+  for name in sorted(types):
+    if kinds[name] == 'scalar':
+      continue
+    at = index
+    if kinds[name] == 'strided':
+      at = '(%s) * pycpc_%s_stride' % (index, name)
+    if name in outputs:
+      lines.append('%s &%s = pycpc_%s[%s];' % (_cpp(types[name]), name, name,
+          at))
+    else:
+      lines.append('const %s %s = pycpc_%s[%s];' % (_cpp(types[name]), name,
+          name, at))
+  return lines
+
+
+def _restrict_lines(types, kinds):
+  lines = []
+  for name in sorted(types):
+    if kinds[name] != 'scalar':
+      lines.append('%s* __restrict pycpc_%s = %s;' % (_cpp(types[name]),
+          name, name))
+  return lines
+
+
+def loop_source(expr, types, outputs, kinds):
+  ''' Returns the body of a kernel running expr over arrays
+  \param types dict of argument name to dtype
+  \param outputs names of arguments written by expr
+  \param kinds dict of argument name to 'scalar', 'array' (contiguous) or
+      'strided'
+  >>> print loop_source('y = a * x', dict(a=float, x=float, y=float), ['y'],
+  ...     dict(a='scalar', x='array', y='array'))
+  double* __restrict pycpc_x = x;
+  double* __restrict pycpc_y = y;
+  #pragma GCC ivdep
+  for (int64_t pycpc_i = 0; pycpc_i < pycpc_n; pycpc_i++) {
+    const double x = pycpc_x[pycpc_i];
+    double &y = pycpc_y[pycpc_i];
+    y = a * x;
+  }
+  '''
+  lines = _restrict_lines(types, kinds)
+  # gcc does not trust __restrict on locals, without ivdep it checks overlap
+  lines.append('#pragma GCC ivdep')
+  lines.append('for (int64_t pycpc_i = 0; pycpc_i < pycpc_n; pycpc_i++) {')
+  lines += ['  ' + l for l in _element_lines(types, outputs, kinds)]
+  expr = expr.strip()
+  lines.append('  %s%s' % (expr, '' if expr.endswith(';') else ';'))
+  lines.append('}')
+  return '\n'.join(lines)
+
+
+def _array(obj):
+  ''' Returns (address, length, stride) of an array, None for a scalar '''
+  if isinstance(obj, vectors.CVector):
+    return obj.address(), len(obj), 1
+  if cppinl.buffer_format(obj) is None:
+    return None
+  iface = getattr(obj, '__array_interface__', None)
+  if iface is None:
+    return cppinl.buffer_address(obj), len(obj), 1
+  if len(iface['shape']) != 1:
+    raise ValueError('kernels take 1-d arrays, got shape %s' %
+        (iface['shape'],))
+  stride = 1
+  if iface.get('strides') is not None:
+    itemsize = int(iface['typestr'][2:])
+    if iface['strides'][0] % itemsize:
+      raise ValueError('stride is not a multiple of the element size')
+    stride = iface['strides'][0] // itemsize
+  return iface['data'][0], iface['shape'][0], stride
+
+
+def _pointer(dtype, obj, address):
+  ''' Returns a handle to pass an array, which the loop may read strided '''
+  if isinstance(obj, cppinl.CHandle):
+    return obj
+  # not as_handle(obj), which refuses strided and read-only arrays
+  handle = cppinl.CHandle(vectors.DTYPES[dtype])
+  handle.ptr[0] = ctypes.cast(address, type(handle.ptr[0]))
+  return handle
+
+
+class ArrayKernel(object):
+  ''' Compiled loops over arrays, one per kind of call (see loop_source) '''
+  def __init__(self, types, outputs, ctx=None):
+    '''
+    \param types dict of argument name to dtype (see CVector)
+    \param outputs names of the arguments written
+    \param ctx the Context to compile with (default: Context())
+    '''
+    self.types = dict((name, vectors.dtype_name(dtype))
+        for name, dtype in types.items())
+    self.outputs = list(outputs)
+    self.inputs = sorted(set(self.types) - set(self.outputs))
+    self.context = ctx if ctx is not None else context.Context()
+    # loop kind -> CPPLib
+    self.libs = {}
+    self.lock = threading.Lock()
+
+  def arguments(self, kinds):
+    ''' Returns the decl_func arguments of the arrays and scalars '''
+    args = {}
+    for name in self.types:
+      ctype = vectors.DTYPES[self.types[name]]
+      if kinds[name] == 'scalar':
+        args[name] = ctype
+      else:
+        args[name] = cppinl.CHandle(ctype)
+      if kinds[name] == 'strided':
+        args['pycpc_%s_stride' % name] = long
+    return args
+
+  def library(self, kinds, declare):
+    ''' Returns the compiled library for the kinds of the arguments
+    \param declare function of (lbuild, kinds) declaring the functions of
+        the loop in a CPPLibBuilder, called once per kinds
+    '''
+    key = tuple(sorted(kinds.items()))
+    with self.lock:
+      if key not in self.libs:
+        lbuild = context.CPPLibBuilder(self.context)
+        declare(lbuild, kinds)
+        self.libs[key] = lbuild.make()
+      return self.libs[key]
+
+  def bind(self, args, allocate=True):
+    ''' Returns (n, kinds, call) to call a loop with the arrays of args
+    Inputs which are lists, or arrays of another type, are converted. Missing
+    outputs are allocated into args if allocate is True.
+    '''
+    unknown = set(args) - set(self.types)
+    if unknown:
+      raise TypeError('unknown arguments: %s' % ', '.join(sorted(unknown)))
+    missing = set(self.inputs) - set(args)
+    if missing:
+      raise TypeError('missing arguments: %s' % ', '.join(sorted(missing)))
+
+    infos = {}
+    for name, val in args.items():
+      typestr = vectors.dtype_typestr(self.types[name])[1:]
+      if (name in self.inputs and hasattr(val, '__len__') and
+          cppinl.buffer_format(val) != typestr):
+        # a list or an array of another type, converted once
+        val = array.array(vectors._array_typecode(
+            vectors.DTYPES[self.types[name]]), val)
+      infos[name] = _array(val)
+      if name in self.outputs and cppinl.buffer_format(val) != typestr:
+        raise TypeError('output %s must be an array of %s' % (name,
+            self.types[name]))
+      iface = getattr(val, '__array_interface__', None)
+      if name in self.outputs and iface is not None and iface['data'][1]:
+        raise TypeError('output %s is read-only' % name)
+      args[name] = val
+
+    lengths = set(info[1] for info in infos.values() if info is not None)
+    lengths.discard(1)
+    if len(lengths) > 1:
+      raise ValueError('arrays of different lengths: %s' %
+          ', '.join(map(str, sorted(lengths))))
+    n = lengths.pop() if lengths else (1 if any(infos.values()) else None)
+    if n is None:
+      raise ValueError('%s needs at least one array' % type(self).__name__)
+
+    for name in self.outputs:
+      if name not in args and allocate:
+        args[name] = vectors.CVector(self.types[name], size=n)
+        infos[name] = _array(args[name])
+
+    kinds = {}
+    call = {}
+    for name in self.types:
+      info = infos[name]
+      if info is None or (info[1] == 1 and n != 1 and
+          name not in self.outputs):
+        kinds[name] = 'scalar'
+        call[name] = args[name] if info is None else args[name][0]
+      else:
+        kinds[name] = 'array' if info[2] == 1 else 'strided'
+        call[name] = _pointer(self.types[name], args[name], info[0])
+        if info[2] != 1:
+          call['pycpc_%s_stride' % name] = info[2]
+      if name in self.outputs and info[1] != n:
+        raise ValueError('output %s has length %d, not %d' % (name, info[1],
+            n))
+    return n, kinds, call
+
+
+class Elementwise(ArrayKernel):
+  ''' A kernel computing an expression for each element, see elementwise() '''
+  def __init__(self, expr, types, outputs=None, ctx=None):
+    '''
+    \param expr C++ statements, eg. 'out = a * b + c'
+    \param types dict of argument name to dtype (see CVector)
+    \param outputs names written by expr (default: the names it assigns)
+    \param ctx the Context to compile with (default: Context())
+    '''
+    if outputs is None:
+      outputs = [name for name in _assigned.findall(expr) if name in types]
+    unique = []
+    for name in outputs:
+      if name not in types:
+        raise ValueError('output %s has no type' % name)
+      if name not in unique:
+        unique.append(name)
+    if not unique:
+      raise ValueError('%r assigns none of %s' % (expr,
+          ', '.join(sorted(types))))
+    ArrayKernel.__init__(self, types, unique, ctx)
+    self.expr = expr
+
+  def declare(self, lbuild, kinds):
+    lbuild.decl_func('pycpc_elementwise', loop_source(self.expr, self.types,
+        self.outputs, kinds), pycpc_n=long, **self.arguments(kinds))
+
+  def __call__(self, **args):
+    ''' Runs the kernel, returning the output, or a tuple of the outputs
+    Missing outputs are allocated, with the length of the input arrays.
+    '''
+    n, kinds, call = self.bind(args)
+    if n:
+      self.library(kinds, self.declare)['pycpc_elementwise'](pycpc_n=n, **call)
+    if len(self.outputs) == 1:
+      return args[self.outputs[0]]
+    return tuple(args[name] for name in self.outputs)
+
+  def __repr__(self):
+    return 'Elementwise(%r, %r)' % (self.expr, self.types)
+
+
+def elementwise(expr, outputs=None, ctx=None, **types):
+  ''' Returns an Elementwise kernel computing expr for each element
+  \param expr C++ statements, eg. 'out = a * b + c'
+  \param outputs names written by expr (default: the names it assigns)
+  \param ctx the Context to compile with
+  \param types the dtype of each argument, eg. a=float
+  '''
+  return Elementwise(expr, types, outputs, ctx)
+
+
+# accumulators per chunk
+ACCUMULATORS = 8
+
+# elements per chunk, the same whatever the number of threads
+CHUNK = 1 << 16
+
+_limits = 'std::numeric_limits<pycpc_acc_t>::'
+
+# combine -> (C++ combining partial results a and b, init)
+REDUCTIONS = {
+  'sum' : ('a + b', '0'),
+  'prod' : ('a * b', '1'),
+  'min' : ('b < a ? b : a', '%shas_infinity ? %sinfinity() : %smax()' % (
+      (_limits,) * 3)),
+  'max' : ('b > a ? b : a', '%shas_infinity ? -%sinfinity() : %slowest()' % (
+      (_limits,) * 3)),
+  'count' : ('a + b', '0'),
+  # the value is unused until the first element, see reduce_source
+  'argmin' : ('<', 'pycpc_acc_t()'),
+  'argmax' : ('>', 'pycpc_acc_t()'),
+}
+
+# reductions returning the index of an element
+_ARG_REDUCTIONS = ('argmin', 'argmax')
+
+
+def reduce_source(expr, combine, init, types, kinds,
+    accumulators=ACCUMULATORS):
+  ''' Returns the body of a kernel reducing expr over [pycpc_begin, pycpc_end)
+  The result is returned and stored at pycpc_slot of pycpc_partials (and
+  pycpc_indices for argmin and argmax).
+  \param expr C++ expression of the value of an element
+  \param combine name in REDUCTIONS, or C++ expression combining a and b
+  \param init C++ expression of the initial value
+  '''
+  arg = combine in _ARG_REDUCTIONS
+  if combine == 'count':
+    expr = '(%s) ? 1 : 0' % expr
+  lines = _restrict_lines(types, kinds)
+  lines.append('pycpc_acc_t pycpc_acc[%d];' % accumulators)
+  if arg:
+    # the index -1 is worse than any element
+    lines.append('int64_t pycpc_at[%d];' % accumulators)
+    lines.append('auto pycpc_better = [](pycpc_acc_t av, int64_t ai, '
+        'pycpc_acc_t bv, int64_t bi) {')
+    lines.append('  return bi >= 0 && (ai < 0 || bv %s av || (bv == av && '
+        'bi < ai));' % REDUCTIONS[combine][0])
+    lines.append('};')
+  else:
+    lines.append('auto pycpc_combine = [](pycpc_acc_t a, pycpc_acc_t b) '
+        '-> pycpc_acc_t {')
+    lines.append('  return %s;' % combine)
+    lines.append('};')
+  lines.append('for (int k = 0; k < %d; k++) {' % accumulators)
+  lines.append('  pycpc_acc[k] = %s;' % init)
+  if arg:
+    lines.append('  pycpc_at[k] = -1;')
+  lines.append('}')
+
+  def step(k, index):
+    out = ['{']
+    out += ['  ' + l for l in _element_lines(types, (), kinds, index)]
+    if arg:
+      out.append('  const pycpc_acc_t pycpc_v = (%s);' % expr)
+      out.append('  if (pycpc_better(pycpc_acc[%d], pycpc_at[%d], pycpc_v, '
+          '%s)) {' % (k, k, index))
+      out.append('    pycpc_acc[%d] = pycpc_v;' % k)
+      out.append('    pycpc_at[%d] = %s;' % (k, index))
+      out.append('  }')
+    else:
+      out.append('  pycpc_acc[%d] = pycpc_combine(pycpc_acc[%d], (%s));' % (
+          k, k, expr))
+    out.append('}')
+    return out
+
+  lines.append('int64_t pycpc_i = pycpc_begin;')
+  lines.append('for (; pycpc_i + %d <= pycpc_end; pycpc_i += %d) {' % (
+      accumulators, accumulators))
+  for k in range(accumulators):
+    lines += ['  ' + l for l in step(k, 'pycpc_i + %d' % k)]
+  lines.append('}')
+  lines.append('for (; pycpc_i < pycpc_end; pycpc_i++) {')
+  lines += ['  ' + l for l in step(0, 'pycpc_i')]
+  lines.append('}')
+  # the accumulators are combined as a tree too
+  lines.append('for (int s = 1; s < %d; s *= 2) {' % accumulators)
+  lines.append('  for (int k = 0; k + s < %d; k += 2 * s) {' % accumulators)
+  if arg:
+    lines.append('    if (pycpc_better(pycpc_acc[k], pycpc_at[k], '
+        'pycpc_acc[k + s], pycpc_at[k + s])) {')
+    lines.append('      pycpc_acc[k] = pycpc_acc[k + s];')
+    lines.append('      pycpc_at[k] = pycpc_at[k + s];')
+    lines.append('    }')
+  else:
+    lines.append('    pycpc_acc[k] = pycpc_combine(pycpc_acc[k], '
+        'pycpc_acc[k + s]);')
+  lines.append('  }')
+  lines.append('}')
+  lines.append('pycpc_partials[pycpc_slot] = pycpc_acc[0];')
+  if arg:
+    lines.append('pycpc_indices[pycpc_slot] = pycpc_at[0];')
+    lines.append('return pycpc_at[0];')
+  else:
+    lines.append('return pycpc_acc[0];')
+  return '\n'.join(lines)
+
+
+def tree_source(combine):
+  ''' Returns the body of a kernel combining pycpc_n partial results as a
+  tree, in place
+  '''
+  arg = combine in _ARG_REDUCTIONS
+  lines = ['for (int64_t s = 1; s < pycpc_n; s *= 2) {',
+      '  for (int64_t k = 0; k + s < pycpc_n; k += 2 * s) {']
+  if arg:
+    # see reduce_source, but partials of chunks are never empty
+    lines += [
+      '    pycpc_acc_t av = pycpc_partials[k], bv = pycpc_partials[k + s];',
+      '    int64_t ai = pycpc_indices[k], bi = pycpc_indices[k + s];',
+      '    if (bi >= 0 && (ai < 0 || bv %s av || (bv == av && bi < ai))) {' %
+          REDUCTIONS[combine][0],
+      '      pycpc_partials[k] = bv;',
+      '      pycpc_indices[k] = bi;',
+      '    }']
+  else:
+    lines += [
+      '    pycpc_acc_t a = pycpc_partials[k], b = pycpc_partials[k + s];',
+      '    pycpc_partials[k] = %s;' % combine]
+  lines += ['  }', '}']
+  lines.append('return %s[0];' % ('pycpc_indices' if arg else
+      'pycpc_partials'))
+  return '\n'.join(lines)
+
+
+class Reduction(ArrayKernel):
+  ''' A kernel reducing an expression over arrays, see reduce() '''
+  def __init__(self, expr, types, init=None, combine='sum', dtype=None,
+      jobs=None, chunk=CHUNK, ctx=None):
+    '''
+    \param expr C++ expression of the value of an element, eg. 'a * b'
+    \param types dict of argument name to dtype (see CVector)
+    \param init C++ expression or number, the initial value (default: the
+        identity of a combine in REDUCTIONS)
+    \param combine name in REDUCTIONS, or a C++ expression combining partial
+        results a and b, eg. 'a + b'
+    \param dtype the type of the values and the result (default: the type of
+        the arguments if they have one, else float64), int64 for count.
+        argmin and argmax return the index of the first extreme value, -1 if
+        there are none
+    \param jobs number of threads (default: one per CPU)
+    \param chunk elements reduced by each call
+    \param ctx the Context to compile with (default: Context())
+    '''
+    ArrayKernel.__init__(self, types, (), ctx)
+    self.expr = expr
+    self.name = combine if combine in REDUCTIONS else None
+    if self.name is not None:
+      combine = REDUCTIONS[self.name][0] if self.name not in \
+          _ARG_REDUCTIONS else self.name
+      if init is None:
+        init = REDUCTIONS[self.name][1]
+    if init is None:
+      raise ValueError('a reduction with combine=%r needs an init' % combine)
+    if dtype is None:
+      dtypes = set(self.types.values())
+      dtype = dtypes.pop() if len(dtypes) == 1 else 'float64'
+    if self.name == 'count':
+      dtype = 'int64'
+    self.combine = combine
+    self.init = str(init)
+    self.dtype = vectors.dtype_name(dtype)
+    self.rtype = long if combine in _ARG_REDUCTIONS else \
+        vectors.DTYPES[self.dtype]
+    self.jobs = jobs
+    self.chunk = chunk
+
+  def declare(self, lbuild, kinds):
+    lbuild.declare('#include <limits>')
+    lbuild.declare('typedef %s pycpc_acc_t;' % _cpp(self.dtype))
+    partials = dict(pycpc_partials=cppinl.CHandle(vectors.DTYPES[self.dtype]))
+    if self.combine in _ARG_REDUCTIONS:
+      partials['pycpc_indices'] = cppinl.CHandle(long)
+    lbuild.decl_func('pycpc_reduce', reduce_source(self.expr, self.combine,
+        self.init, self.types, kinds), rtype=self.rtype, pycpc_begin=long,
+        pycpc_end=long, pycpc_slot=long, **dict(partials,
+        **self.arguments(kinds)))
+    lbuild.decl_func('pycpc_tree', tree_source(self.combine),
+        rtype=self.rtype, pycpc_n=long, **partials)
+
+  def __call__(self, **args):
+    ''' Returns the reduction of the arrays of args '''
+    n, kinds, call = self.bind(args)
+    lib = self.library(kinds, self.declare)
+    kernel = lib['pycpc_reduce']
+    parts = parallel.chunks(n, self.chunk) or [(0, 0)]
+    # array.array, cheaper to allocate than CVector for a call
+    partials = dict(pycpc_partials=array.array(vectors._array_typecode(
+        vectors.DTYPES[self.dtype]), [0]) * len(parts))
+    if self.combine in _ARG_REDUCTIONS:
+      partials['pycpc_indices'] = array.array(vectors._array_typecode(
+          ctypes.c_int64), [0]) * len(parts)
+
+    def run(slot):
+      start, length = parts[slot]
+      return kernel(pycpc_begin=start, pycpc_end=start + length,
+          pycpc_slot=slot, **dict(partials, **call))
+
+    if len(parts) == 1:
+      return run(0)
+    jobs = self.jobs if self.jobs is not None else pool.default_jobs()
+    workers = pool.sized_pool(jobs)
+    if jobs == 1 or workers.owns_thread():
+      map(run, range(len(parts)))
+    else:
+      for f in workers.map(run, range(len(parts))):
+        f.result()
+    return lib['pycpc_tree'](pycpc_n=len(parts), **partials)
+
+  def __repr__(self):
+    return 'Reduction(%r, %r, %r)' % (self.expr, self.combine, self.types)
+
+
+def reduce(expr, init=None, combine='sum', dtype=None, jobs=None,
+    chunk=CHUNK, ctx=None, **types):
+  ''' Returns a Reduction kernel, see Reduction
+  >>> sorted(REDUCTIONS)
+  ['argmax', 'argmin', 'count', 'max', 'min', 'prod', 'sum']
+  '''
+  return Reduction(expr, types, init, combine, dtype, jobs, chunk, ctx)
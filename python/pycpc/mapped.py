@@ -0,0 +1,290 @@
+import ctypes
+import ctypes.util
+import os
+import vectors
+
+"""
+Vectors backed by memory mapped files
+
+A MappedVector maps a binary file of elements (eg. written by
+CVector.to_bytes or numpy.ndarray.tofile) into memory, and is passed to
+kernels like any CVector, as a `T*` to the file's data:
+
+  v = mapped.MappedVector('data.i64', 'int64')
+  total = lib.sum(v, len(v))
+
+Pages are read from the file as the kernel touches them, so kernels may be
+given files larger than memory, whose pages the operating system evicts as
+needed. The file is not parsed or copied by python. The modes are those of
+numpy.memmap:
+  r   read only, writes from python raise ValueError, from C++ they crash
+      the process
+  c   copy on write, changes are private and never reach the file
+  r+  shared, changes are written to the file
+  w+  creates or truncates the file to the size given, shared
+Files can be streamed through a window at a time with windows(), which
+only maps a window at once.
+"""
+
+PROT_READ = 0x1
+PROT_WRITE = 0x2
+MAP_SHARED = 0x1
+MAP_PRIVATE = 0x2
+MS_SYNC = 0x4
+
+# mode -> (mmap prot, mmap flags, open flags)
+MODES = {
+  'r' : (PROT_READ, MAP_SHARED, os.O_RDONLY),
+  'c' : (PROT_READ | PROT_WRITE, MAP_PRIVATE, os.O_RDONLY),
+  'r+' : (PROT_READ | PROT_WRITE, MAP_SHARED, os.O_RDWR),
+  'w+' : (PROT_READ | PROT_WRITE, MAP_SHARED, os.O_RDWR | os.O_CREAT |
+      os.O_TRUNC),
+}
+
+# madvise advice of linux
+ADVICE = {
+  'normal' : 0,
+  'random' : 1,
+  'sequential' : 2,
+  'willneed' : 3,
+  'dontneed' : 4,
+  'hugepage' : 14,
+  'nohugepage' : 15,
+}
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+_libc = None
+
+
+def libc():
+  ''' Returns libc with the signatures of the functions used here '''
+  global _libc
+  if _libc is None:
+    lib = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    lib.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int,
+        ctypes.c_int, ctypes.c_int, ctypes.c_int64]
+    lib.mmap.restype = ctypes.c_void_p
+    lib.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    lib.munmap.restype = ctypes.c_int
+    lib.madvise.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
+    lib.madvise.restype = ctypes.c_int
+    lib.msync.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
+    lib.msync.restype = ctypes.c_int
+    _libc = lib
+  return _libc
+
+
+def _check(ret, what, path):
+  if ret != 0:
+    err = ctypes.get_errno()
+    raise OSError(err, '%s failed: %s' % (what, os.strerror(err)), path)
+
+
+# what mmap returns on failure, (void*) -1
+_MAP_FAILED = ctypes.c_void_p(-1).value
+
+
+class MappedVector(vectors.CVector):
+  ''' A CVector of the elements of a file, mapped into memory
+  Mapped vectors can not grow. The mapping is removed by close(), when used
+  as a context manager, or when the vector is garbage collected, after which
+  views of it and pointers held by C++ are invalid.
+  '''
+  def __init__(self, path, dtype='int64', mode='r', offset=0, size=None,
+      advice=None):
+    '''
+    \param path the file
+    \param dtype the element type, see CVector
+    \param mode one of MODES
+    \param offset position in the file of the first element, in bytes
+    \param size number of elements (default: to the end of the file),
+        needed for mode w+
+    \param advice name in ADVICE, or a list of names, see advise()
+    '''
+    vectors.CVector.__init__(self, dtype)
+    if mode not in MODES:
+      raise ValueError('unknown mode %r, not one of %s' % (mode,
+          ', '.join(sorted(MODES))))
+    self.path = path
+    self.mode = mode
+    self.offset = offset
+    self._map = None
+    self._map_len = 0
+    prot, flags, oflags = MODES[mode]
+    if mode == 'w+' and size is None:
+      raise ValueError('mode w+ needs a size')
+    fd = os.open(path, oflags, 0666)
+    try:
+      if mode == 'w+':
+        os.ftruncate(fd, offset + size * self.itemsize())
+      if size is None:
+        size = max(os.fstat(fd).st_size - offset, 0) // self.itemsize()
+      nbytes = size * self.itemsize()
+      if nbytes:
+        # the mapping starts at a page, the elements a little after it
+        start = offset - offset % PAGE_SIZE
+        length = nbytes + offset - start
+        addr = libc().mmap(None, length, prot, flags, fd, start)
+        if addr in (None, _MAP_FAILED):
+          _check(-1, 'mmap', path)
+        self._map = addr
+        self._map_len = length
+        self.ptr[0] = ctypes.cast(addr + offset - start,
+            ctypes.POINTER(self.ctype))
+      self.size = long(size)
+      self.capacity = self.size
+    finally:
+      # the mapping keeps the file open
+      os.close(fd)
+    if advice is not None:
+      self.advise(advice)
+
+  def advise(self, advice, start=0, stop=None):
+    ''' Tells the kernel how elements [start, stop) will be used
+    \param advice name in ADVICE, or a list of names, eg. 'sequential' to
+        read ahead more and drop pages after they are read, 'willneed' to
+        start reading now, 'hugepage' to back the mapping with huge pages
+        where the operating system supports it for files
+    '''
+    if isinstance(advice, (list, tuple)):
+      for a in advice:
+        self.advise(a, start, stop)
+      return
+    if advice not in ADVICE:
+      raise ValueError('unknown advice %r, not one of %s' % (advice,
+          ', '.join(sorted(ADVICE))))
+    addr, length = self._pages(start, stop)
+    if length:
+      _check(libc().madvise(addr, length, ADVICE[advice]), 'madvise',
+          self.path)
+
+  def flush(self):
+    ''' Writes changes to the file now, rather than when the kernel chooses
+    '''
+    if self._map is not None and self.mode in ('r+', 'w+'):
+      _check(libc().msync(self._map, self._map_len, MS_SYNC), 'msync',
+          self.path)
+
+  def _pages(self, start, stop):
+    ''' Returns (address, length) of the pages holding [start, stop) '''
+    start, stop = self._range(start, stop)
+    if self._map is None or start == stop:
+      return self._map, 0
+    begin = self.address() + start * self.itemsize()
+    end = self.address() + stop * self.itemsize()
+    begin -= begin % PAGE_SIZE
+    return begin, end - begin
+
+  def close(self):
+    ''' Unmaps the file, changes of a shared mapping are kept '''
+    if self._map is not None:
+      _check(libc().munmap(self._map, self._map_len), 'munmap', self.path)
+      self._map = None
+      self._map_len = 0
+    self.ptr[0] = None
+    self.size = 0
+    self.capacity = 0
+
+  def _reserve(self, need, grow):
+    raise ValueError('cannot grow a vector mapped from %s' % self.path)
+
+  def release(self):
+    self.close()
+
+  def free(self):
+    self.close()
+
+  def _view_class(self):
+    if self.mode == 'r':
+      return ReadOnlyView
+    return vectors.CVector
+
+  @property
+  def __array_interface__(self):
+    iface = vectors.CVector.__array_interface__.fget(self)
+    iface['data'] = (self.address(), self.mode == 'r')
+    return iface
+
+  def _check_writable(self):
+    if self.mode == 'r':
+      raise ValueError('%s is mapped read only' % self.path)
+
+  def __setitem__(self, idx, v):
+    self._check_writable()
+    vectors.CVector.__setitem__(self, idx, v)
+
+  def copy_from(self, src, offset=0):
+    self._check_writable()
+    vectors.CVector.copy_from(self, src, offset)
+
+  def __del__(self):
+    try:
+      self.close()
+    except (AttributeError, TypeError, OSError):
+      # partly constructed, or at interpreter exit
+      pass
+
+  def __repr__(self):
+    return 'MappedVector(%r, %r, %r, size=%d)' % (self.path, self.dtype,
+        self.mode, self.size)
+
+  __str__ = __repr__
+
+
+class ReadOnlyView(vectors.CVector):
+  ''' A view of a read only mapping, which refuses writes like it '''
+  @property
+  def __array_interface__(self):
+    iface = vectors.CVector.__array_interface__.fget(self)
+    iface['data'] = (self.address(), True)
+    return iface
+
+  def __setitem__(self, idx, v):
+    raise ValueError('view of a read only mapping')
+
+  def copy_from(self, src, offset=0):
+    raise ValueError('view of a read only mapping')
+
+
+def create(path, dtype, size):
+  ''' Creates a file of size zeroed elements and returns it mapped '''
+  return MappedVector(path, dtype, 'w+', size=size)
+
+
+def windows(path, dtype='int64', window=1 << 20, step=None, mode='r',
+    offset=0, advice='sequential'):
+  ''' Yields (start, vector) for consecutive windows of a file
+  Only one window is mapped at a time, so files larger than memory (and
+  than the address space) can be streamed through a kernel. A window is
+  unmapped when the next is yielded, copy what must be kept.
+  \param window elements per window, the last may be shorter
+  \param step elements from the start of a window to the next (default:
+      window), less than window for overlapping windows
+  \param mode one of MODES, but w+
+  \param offset position in the file of the first element, in bytes
+  \param advice advice for each window, see MappedVector.advise.
+      'sequential' also asks for the window to be read ahead
+  '''
+  if mode == 'w+':
+    raise ValueError('windows can not create a file')
+  if step is None:
+    step = window
+  if window <= 0 or step <= 0:
+    raise ValueError('window and step must be positive')
+  itemsize = ctypes.sizeof(vectors.DTYPES[vectors.dtype_name(dtype)])
+  total = max(os.path.getsize(path) - offset, 0) // itemsize
+  if advice == 'sequential':
+    advice = ['sequential', 'willneed']
+  start = 0
+  while start < total:
+    size = min(window, total - start)
+    vec = MappedVector(path, dtype, mode, offset + start * itemsize, size,
+        advice)
+    try:
+      yield start, vec
+    finally:
+      vec.close()
+    if start + size >= total:
+      break
+    start += step
@@ -0,0 +1,85 @@
+import pool
+import vectors
+
+"""
+Running a kernel over a vector in chunks, on several threads
+
+Compiled functions release the GIL while they run, so calling a kernel on
+separate parts of a vector from a pool of threads uses several cores
+without threading code in C++:
+
+  lbuild.decl_func('total', '...', v=vec, n=long, rtype=long)
+  lib = lbuild.make()
+  total = pycpc.parallel_for(lib['total'], vec, combine=sum)
+"""
+
+# the smallest default chunk, in elements
+MIN_CHUNK = 1 << 14
+
+# chunks per thread by default, more chunks balance uneven work better
+CHUNKS_PER_JOB = 4
+
+def chunks(size, chunk):
+  ''' Returns a list of (offset, length) covering range(size)
+  >>> chunks(10, 4)
+  [(0, 4), (4, 4), (8, 2)]
+  '''
+  return [(i, min(chunk, size - i)) for i in xrange(0, size, chunk)]
+
+
+def parallel_for(kernel, vector, chunk=None, jobs=None, args={}, names=('v', 
+    'n'), offset=None, combine=None, native_combine=None):
+  ''' Calls a kernel on chunks of a vector concurrently
+  The kernel is called with keyword arguments, a view of a chunk of the
+  vector and its length under names, and the extra args. 
+  \param kernel a function taking keyword arguments, eg. lib['foo'] or an 
+      InlineFunc
+  \param vector a CVector
+  \param chunk elements per call (default: a few chunks per thread)
+  \param jobs number of threads (default: one per CPU)
+  \param args dict of other arguments of the kernel
+  \param names the kernel's argument names of the chunk and its length
+  \param offset if given, the argument name of the offset of the chunk
+  \param combine function of the list of results of the kernel, (eg. sum)
+  \param native_combine kernel called like kernel on a vector of the
+      results, for a combining step in C++
+  \\return the results of the chunks in order, or the combined result
+  '''
+  if jobs is None:
+    jobs = pool.default_jobs()
+  size = len(vector)
+  if chunk is None:
+    chunk = max(MIN_CHUNK, -(-size // (jobs * CHUNKS_PER_JOB)))
+  vname, nname = names
+
+  def run(part):
+    start, length = part
+    kwargs = dict(args)
+    kwargs[vname] = vector.view(start, length)
+    kwargs[nname] = length
+    if offset is not None:
+      kwargs[offset] = start
+    return kernel(**kwargs)
+
+  parts = chunks(size, chunk)
+  workers = pool.sized_pool(jobs)
+  if len(parts) <= 1 or jobs == 1 or workers.owns_thread():
+    # nothing to split, or already on a worker which must not wait on others
+    results = map(run, parts)
+  else:
+    results = [f.result() for f in workers.map(run, parts)]
+
+  if combine is not None:
+    return combine(results)
+  if native_combine is not None:
+    dtype = any(isinstance(r, float) for r in results) and 'float64' \
+        or 'int64'
+    partials = vectors.CVector(dtype, size=len(results))
+    partials[:] = results
+    kwargs = dict(args)
+    kwargs[vname] = partials
+    kwargs[nname] = len(results)
+    if offset is not None:
+      kwargs[offset] = 0
+    return native_combine(**kwargs)
+  return results
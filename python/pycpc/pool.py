@@ -0,0 +1,174 @@
+import sys
+import threading
+import Queue
+import multiprocessing
+
+"""
+A small bounded worker pool with futures
+
+Python threads are enough to run compiler processes and native kernels
+concurrently, since waiting on a child process or calling into a ctypes.CDLL
+function releases the GIL.
+"""
+
+
+_local = threading.local()
+
+
+def in_worker():
+  ''' True on a thread of any WorkerPool '''
+  return getattr(_local, 'worker', False)
+
+
+def default_jobs():
+  ''' Number of workers to use when none is given, one per CPU '''
+  try:
+    return multiprocessing.cpu_count()
+  except NotImplementedError:
+    return 1
+
+
+class Future(object):
+  ''' The eventual result of a job submitted to a WorkerPool '''
+  def __init__(self):
+    self._event = threading.Event()
+    self._lock = threading.Lock()
+    self._result = None
+    self._exc_info = None
+    self._callbacks = []
+    self._canceller = None
+
+  def done(self):
+    return self._event.is_set()
+
+  def set_canceller(self, fn):
+    ''' Sets the function cancel() calls to stop the job '''
+    self._canceller = fn
+
+  def cancel(self):
+    ''' Asks the job to stop, returns False if it already finished or cannot
+    be cancelled. A cancelled job finishes by raising an exception.
+    '''
+    if self.done() or self._canceller is None:
+      return False
+    self._canceller()
+    return True
+
+  def result(self, timeout=None):
+    ''' Waits for the job and returns its result, re-raising its exception '''
+    if not self._event.wait(timeout):
+      raise RuntimeError('timed out waiting for result')
+    if self._exc_info is not None:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    return self._result
+
+  def exception(self, timeout=None):
+    ''' Waits for the job and returns the exception it raised, or None '''
+    if not self._event.wait(timeout):
+      raise RuntimeError('timed out waiting for result')
+    if self._exc_info is None:
+      return None
+    return self._exc_info[1]
+
+  def add_done_callback(self, fn):
+    ''' Calls fn(future) once the job finishes (immediately if it has) '''
+    with self._lock:
+      if not self._event.is_set():
+        self._callbacks.append(fn)
+        return
+    fn(self)
+
+  def set_result(self, result):
+    self._result = result
+    self._finish()
+
+  def set_exception(self, exc_info):
+    self._exc_info = exc_info
+    self._finish()
+
+  def _finish(self):
+    with self._lock:
+      self._event.set()
+      callbacks, self._callbacks = self._callbacks, []
+    for fn in callbacks:
+      fn(self)
+
+
+class WorkerPool(object):
+  ''' Runs submitted functions on at most `jobs` threads '''
+  def __init__(self, jobs=None):
+    if jobs is None:
+      jobs = default_jobs()
+    self.jobs = max(1, int(jobs))
+    self._queue = Queue.Queue()
+    self._threads = []
+    self._lock = threading.Lock()
+
+  def submit(self, fn, *args, **kwargs):
+    ''' Schedules fn(*args, **kwargs) and returns a Future for its result '''
+    fut = Future()
+    self._queue.put((fut, fn, args, kwargs))
+    with self._lock:
+      if len(self._threads) < self.jobs:
+        t = threading.Thread(target=self._work)
+        t.daemon = True
+        t.start()
+        self._threads.append(t)
+    return fut
+
+  def owns_thread(self, thread=None):
+    ''' True if thread (default: the current one) is one of the workers '''
+    if thread is None:
+      thread = threading.current_thread()
+    with self._lock:
+      return thread in self._threads
+
+  def map(self, fn, items):
+    ''' Returns a list of futures for fn(item) over items '''
+    return [self.submit(fn, item) for item in items]
+
+  def shutdown(self, wait=True):
+    ''' Stops the workers once queued jobs are finished '''
+    with self._lock:
+      threads, self._threads = self._threads, []
+    for t in threads:
+      self._queue.put(None)
+    if wait:
+      for t in threads:
+        t.join()
+
+  def _work(self):
+    _local.worker = True
+    while True:
+      job = self._queue.get()
+      if job is None:
+        return
+      fut, fn, args, kwargs = job
+      try:
+        fut.set_result(fn(*args, **kwargs))
+      except:
+        fut.set_exception(sys.exc_info())
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+def shared_pool():
+  ''' Returns the process wide pool used for background work '''
+  global _shared
+  with _shared_lock:
+    if _shared is None:
+      _shared = WorkerPool()
+    return _shared
+
+
+_sized = {}
+
+def sized_pool(jobs):
+  ''' Returns the process wide pool of jobs workers, for work split in jobs
+  parts (eg. parallel_for)
+  '''
+  with _shared_lock:
+    if jobs not in _sized:
+      _sized[jobs] = WorkerPool(jobs)
+    return _sized[jobs]
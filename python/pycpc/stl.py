@@ -0,0 +1,370 @@
+import array
+import context
+import cppinl
+import ctypes
+import threading
+import vectors
+
+"""
+STL containers which python can read and write in bulk
+
+StdVector, StdString and StdUnorderedMap are handles to a C++ container,
+passed to kernels like a CHandle with a cast:
+
+  v = stl.StdVector('int32', [1, 2, 3])
+  lbuild.decl_func('push', 'v->push_back(x);', v=v, x=int)
+
+where the kernel gets a `std::vector<int32_t>* &v`. The kernel's context
+needs the header (eg. ctx.add_macro('#include <vector>')).
+
+Python reads and writes the contents through small accessor libraries, one
+per container and element type, which are compiled on first use and then
+come from the compilation cache. Contents cross between python and C++ in
+one call per batch (eg. to_array(), extend()), not per element.
+"""
+
+_libs = {}
+_lock = threading.Lock()
+
+
+def _cpp(dtype):
+  return cppinl.get_cpp_type(vectors.DTYPES[dtype])
+
+
+def _typecode(dtype):
+  return vectors._array_typecode(vectors.DTYPES[dtype])
+
+
+def _common(lbuild, p):
+  ''' Declares the accessors every container has '''
+  lbuild.decl_func('pycpc_stl_new', 'p = new %s();' % p.cast, p=p)
+  lbuild.decl_func('pycpc_stl_delete', 'delete p;\np = NULL;', p=p)
+  lbuild.decl_func('pycpc_stl_size', 'return p->size();', p=p, rtype=long)
+  lbuild.decl_func('pycpc_stl_reserve', 'p->reserve(n);', p=p, n=long)
+  lbuild.decl_func('pycpc_stl_clear', 'p->clear();', p=p)
+
+
+def _vector_builder(dtype):
+  ctx = context.Context()
+  ctx.add_macro('#include <vector>')
+  lbuild = context.CPPLibBuilder(ctx)
+  p = cppinl.CHandle(cast='std::vector<%s>' % _cpp(dtype))
+  data = cppinl.CHandle(vectors.DTYPES[dtype])
+  _common(lbuild, p)
+  lbuild.decl_func('pycpc_stl_export', r'''
+    int64_t size = p->size();
+    if (start >= size)
+      return 0;
+    if (n > size - start)
+      n = size - start;
+    memcpy(out, p->data() + start, n * sizeof(*out));
+    return n;
+  ''', p=p, out=data, start=long, n=long, rtype=long)
+  lbuild.decl_func('pycpc_stl_append', 'p->insert(p->end(), src, src + n);',
+      p=p, src=data, n=long)
+  lbuild.decl_func('pycpc_stl_assign', 'p->assign(src, src + n);', p=p,
+      src=data, n=long)
+  return lbuild
+
+
+def _string_builder():
+  ctx = context.Context()
+  ctx.add_macro('#include <string>')
+  lbuild = context.CPPLibBuilder(ctx)
+  p = cppinl.CHandle(cast='std::string')
+  _common(lbuild, p)
+  lbuild.decl_func('pycpc_stl_export', r'''
+    int64_t size = p->size();
+    if (start >= size)
+      return 0;
+    if (n > size - start)
+      n = size - start;
+    memcpy(out, p->data() + start, n);
+    return n;
+  ''', p=p, out=cppinl.CHandle(ctypes.c_uint8), start=long, n=long,
+      rtype=long)
+  lbuild.decl_func('pycpc_stl_append', 'p->append(src, n);', p=p, src=str,
+      n=long)
+  lbuild.decl_func('pycpc_stl_assign', 'p->assign(src, n);', p=p, src=str,
+      n=long)
+  return lbuild
+
+
+def _map_builder(ktype, vtype):
+  ctx = context.Context()
+  ctx.add_macro('#include <unordered_map>')
+  lbuild = context.CPPLibBuilder(ctx)
+  p = cppinl.CHandle(cast='std::unordered_map<%s,%s>' % (_cpp(ktype),
+      _cpp(vtype)))
+  keys = cppinl.CHandle(vectors.DTYPES[ktype])
+  values = cppinl.CHandle(vectors.DTYPES[vtype])
+  _common(lbuild, p)
+  lbuild.decl_func('pycpc_stl_export', r'''
+    int64_t i = 0;
+    for (auto it = p->begin(); it != p->end() && i < n; ++it, ++i) {
+      keys[i] = it->first;
+      values[i] = it->second;
+    }
+    return i;
+  ''', p=p, keys=keys, values=values, n=long, rtype=long)
+  lbuild.decl_func('pycpc_stl_update', r'''
+    for (int64_t i = 0; i < n; i++)
+      (*p)[keys[i]] = values[i];
+  ''', p=p, keys=keys, values=values, n=long)
+  # returns the number of keys found, the others get dflt
+  lbuild.decl_func('pycpc_stl_lookup', r'''
+    int64_t found = 0;
+    for (int64_t i = 0; i < n; i++) {
+      auto it = p->find(keys[i]);
+      if (it == p->end()) {
+        values[i] = dflt;
+      } else {
+        values[i] = it->second;
+        found++;
+      }
+    }
+    return found;
+  ''', p=p, keys=keys, values=values, n=long, dflt=vectors.DTYPES[vtype],
+      rtype=long)
+  lbuild.decl_func('pycpc_stl_erase', r'''
+    for (int64_t i = 0; i < n; i++)
+      p->erase(keys[i]);
+  ''', p=p, keys=keys, n=long)
+  return lbuild
+
+
+def _library(builder, *dtypes):
+  ''' Returns the accessor library of a container, compiling it once '''
+  key = (builder,) + dtypes
+  with _lock:
+    if key not in _libs:
+      _libs[key] = builder(*dtypes).make()
+    return _libs[key]
+
+
+def _buffer(dtype, seq):
+  ''' Returns seq, or a copy of it, as an array of dtype to pass to C++ '''
+  if isinstance(seq, vectors.CVector) and seq.dtype == dtype:
+    return seq
+  if cppinl.buffer_format(seq) == vectors.dtype_typestr(dtype)[1:]:
+    return seq
+  return array.array(_typecode(dtype), seq)
+
+
+class StdContainer(cppinl.CHandle):
+  ''' A handle to an STL container, see StdVector '''
+  def __init__(self, lib, cast, create=True):
+    '''
+    \param lib the accessor library
+    \param cast the C++ type
+    \param create if True, a new container is allocated, which is deleted
+        with the handle. Otherwise the handle is NULL, to be set by C++.
+    '''
+    cppinl.CHandle.__init__(self, cast=cast)
+    self._lib = lib
+    self.owned = create
+    if create:
+      lib['pycpc_stl_new'](p=self)
+
+  def address(self):
+    return ctypes.cast(self.ptr[0], ctypes.c_void_p).value or 0
+
+  def size(self):
+    if not self.address():
+      return 0
+    return self._lib['pycpc_stl_size'](p=self)
+
+  def __len__(self):
+    return self.size()
+
+  def reserve(self, n):
+    self._lib['pycpc_stl_reserve'](p=self, n=n)
+
+  def clear(self):
+    self._lib['pycpc_stl_clear'](p=self)
+
+  def delete(self):
+    ''' Deletes the container, which may also have been created in C++ '''
+    if self.address():
+      self._lib['pycpc_stl_delete'](p=self)
+    self.owned = False
+
+  def __del__(self):
+    try:
+      if self.owned:
+        self.delete()
+    except (AttributeError, TypeError):
+      # partly constructed, or at interpreter exit
+      pass
+
+
+class StdVector(StdContainer):
+  ''' A std::vector<T> of a CVector dtype '''
+  def __init__(self, dtype='int64', seq=None, create=True):
+    self.dtype = vectors.dtype_name(dtype)
+    StdContainer.__init__(self, _library(_vector_builder, self.dtype),
+        'std::vector<%s>' % _cpp(self.dtype), create)
+    if seq is not None:
+      self.assign(seq)
+
+  def copy_to(self, out, start=0):
+    ''' Copies elements from start into the array out, filling it
+    \return the number of elements copied
+    '''
+    if cppinl.buffer_format(out) != vectors.dtype_typestr(self.dtype)[1:]:
+      raise TypeError('cannot copy %s elements to %s' % (self.dtype,
+          type(out)))
+    return self._lib['pycpc_stl_export'](p=self, out=out, start=start,
+        n=len(out))
+
+  def to_array(self, start=0, stop=None):
+    ''' Returns a copy of the elements [start, stop) as an array.array '''
+    size = self.size()
+    if stop is None or stop > size:
+      stop = size
+    out = array.array(_typecode(self.dtype), [0]) * max(stop - start, 0)
+    if out:
+      self.copy_to(out, start)
+    return out
+
+  def extend(self, seq):
+    ''' Appends the elements of an array or sequence '''
+    src = _buffer(self.dtype, seq)
+    self._lib['pycpc_stl_append'](p=self, src=src, n=len(src))
+
+  def assign(self, seq):
+    ''' Replaces the elements with those of an array or sequence '''
+    src = _buffer(self.dtype, seq)
+    self._lib['pycpc_stl_assign'](p=self, src=src, n=len(src))
+
+  def __getitem__(self, idx):
+    if idx < 0:
+      idx += self.size()
+    out = self.to_array(idx, idx + 1)
+    if not out:
+      raise IndexError(idx)
+    return out[0]
+
+  def __iter__(self):
+    return iter(self.to_array())
+
+  def __repr__(self):
+    return 'StdVector(%r, %r)' % (self.dtype, list(self))
+
+  __str__ = __repr__
+
+
+class StdString(StdContainer):
+  ''' A std::string '''
+  def __init__(self, value=None, create=True):
+    StdContainer.__init__(self, _library(_string_builder), 'std::string',
+        create)
+    if value is not None:
+      self.assign(value)
+
+  def assign(self, value):
+    self._lib['pycpc_stl_assign'](p=self, src=value, n=len(value))
+
+  def extend(self, value):
+    self._lib['pycpc_stl_append'](p=self, src=value, n=len(value))
+
+  def value(self, start=0, stop=None):
+    ''' Returns a copy of the characters [start, stop) as a str '''
+    size = self.size()
+    if stop is None or stop > size:
+      stop = size
+    out = array.array('B', [0]) * max(stop - start, 0)
+    if out:
+      self._lib['pycpc_stl_export'](p=self, out=out, start=start, n=len(out))
+    return out.tostring()
+
+  def __str__(self):
+    return self.value()
+
+  def __repr__(self):
+    return 'StdString(%r)' % self.value()
+
+
+class StdUnorderedMap(StdContainer):
+  ''' A std::unordered_map<K, V> with CVector dtypes as keys and values '''
+  def __init__(self, ktype='int64', vtype='int64', items=None, create=True):
+    self.ktype = vectors.dtype_name(ktype)
+    self.vtype = vectors.dtype_name(vtype)
+    StdContainer.__init__(self, _library(_map_builder, self.ktype,
+        self.vtype), 'std::unordered_map<%s,%s>' % (_cpp(self.ktype),
+        _cpp(self.vtype)), create)
+    if items is not None:
+      self.update(items)
+
+  def update(self, keys, values=None):
+    ''' Sets values of keys, from a dict or arrays of keys and values '''
+    if values is None:
+      items = keys.items() if isinstance(keys, dict) else list(keys)
+      keys = [k for k, v in items]
+      values = [v for k, v in items]
+    keys = _buffer(self.ktype, keys)
+    values = _buffer(self.vtype, values)
+    if len(keys) != len(values):
+      raise ValueError('%d keys but %d values' % (len(keys), len(values)))
+    self._lib['pycpc_stl_update'](p=self, keys=keys, values=values,
+        n=len(keys))
+
+  def lookup(self, keys, default=0):
+    ''' Returns an array of the values of keys, default for missing keys '''
+    keys = _buffer(self.ktype, keys)
+    out = array.array(_typecode(self.vtype), [0]) * len(keys)
+    self._lib['pycpc_stl_lookup'](p=self, keys=keys, values=out, n=len(keys),
+        dflt=default)
+    return out
+
+  def erase(self, keys):
+    keys = _buffer(self.ktype, keys)
+    self._lib['pycpc_stl_erase'](p=self, keys=keys, n=len(keys))
+
+  def arrays(self):
+    ''' Returns copies of the keys and values, as two arrays '''
+    n = self.size()
+    keys = array.array(_typecode(self.ktype), [0]) * n
+    values = array.array(_typecode(self.vtype), [0]) * n
+    if n:
+      self._lib['pycpc_stl_export'](p=self, keys=keys, values=values, n=n)
+    return keys, values
+
+  def keys(self):
+    return self.arrays()[0]
+
+  def values(self):
+    return self.arrays()[1]
+
+  def items(self):
+    return zip(*self.arrays())
+
+  def to_dict(self):
+    return dict(self.items())
+
+  def __getitem__(self, key):
+    keys = _buffer(self.ktype, [key])
+    out = array.array(_typecode(self.vtype), [0])
+    if not self._lib['pycpc_stl_lookup'](p=self, keys=keys, values=out, n=1,
+        dflt=0):
+      raise KeyError(key)
+    return out[0]
+
+  def __setitem__(self, key, value):
+    self.update([key], [value])
+
+  def __delitem__(self, key):
+    self.erase([key])
+
+  def __contains__(self, key):
+    try:
+      self[key]
+      return True
+    except KeyError:
+      return False
+
+  def __repr__(self):
+    return 'StdUnorderedMap(%r, %r, %r)' % (self.ktype, self.vtype,
+        self.to_dict())
+
+  __str__ = __repr__
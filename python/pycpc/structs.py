@@ -0,0 +1,236 @@
+import array
+import cppinl
+import ctypes
+import vectors
+
+"""
+Record types shared by python and C++
+
+A Struct describes a C++ struct from python:
+
+  Point = pycpc.Struct('Point', x=float, y=float, id=long)
+  lbuild.use_struct(Point)
+
+which declares `struct Point { int64_t id; double x; double y; };` (fields
+are in order of their names, like arguments, unless given as a list of
+(name, type) pairs) before the code of the builder, and a ctypes.Structure
+with the same layout. Records are stored either as an array of structs:
+
+  pts = Point.array(1000000)
+  pts[0].x = 1.5
+  lbuild.decl_func('norm', '... pts[i].x ...', pts=pts, n=long)
+
+where the kernel gets a `Point*`, or as a struct of arrays:
+
+  pts = Point.soa(1000000)
+  pts.x[0] = 1.5
+  lbuild.decl_func('norm', '... pts->x[i] ...', pts=pts, n=long)
+
+where the kernel gets a `Point_soa*` holding a pointer per field, and each
+field is a CVector. Neither copies records between python and C++.
+"""
+
+
+class Struct(object):
+  def __init__(self, name, fields=None, **kwargs):
+    '''
+    \param name the name of the C++ struct
+    \param fields list of (name, type) pairs, in order
+    \param kwargs fields given by name, ordered by name after fields
+    Types are dtypes of CVector (eg. 'int16', long, float).
+    '''
+    fields = list(fields or []) + sorted(kwargs.items())
+    self.name = name
+    self.soa_name = name + '_soa'
+    self.fields = [(fname, vectors.dtype_name(typ)) for fname, typ in fields]
+    self.ctype = type(name, (ctypes.Structure,), dict(_fields_=[(fname,
+        vectors.DTYPES[dtype]) for fname, dtype in self.fields]))
+    self.soa_ctype = type(self.soa_name, (ctypes.Structure,), dict(_fields_=[
+        (fname, ctypes.c_void_p) for fname, dtype in self.fields]))
+
+  def field_names(self):
+    return [fname for fname, dtype in self.fields]
+
+  def cpp_type(self, dtype):
+    return cppinl.get_cpp_type(vectors.DTYPES[dtype])
+
+  def declaration(self):
+    ''' Returns the C++ declarations of the struct and its struct of arrays
+    >>> print Struct('P', x=float, id=long).declaration()
+    struct P {
+      int64_t id;
+      double x;
+    };
+    static_assert(sizeof(P) == 16, "layout of P differs from python");
+    struct P_soa {
+      int64_t* id;
+      double* x;
+    };
+    '''
+    lines = ['struct %s {' % self.name]
+    lines += ['  %s %s;' % (self.cpp_type(dtype), fname)
+        for fname, dtype in self.fields]
+    lines += ['};', 'static_assert(sizeof(%s) == %d, '
+        '"layout of %s differs from python");' % (self.name,
+        ctypes.sizeof(self.ctype), self.name)]
+    lines += ['struct %s {' % self.soa_name]
+    lines += ['  %s* %s;' % (self.cpp_type(dtype), fname)
+        for fname, dtype in self.fields]
+    lines += ['};']
+    return '\n'.join(lines)
+
+  def __call__(self, *vals, **kwargs):
+    ''' Returns a record, an instance of ctype '''
+    return self.ctype(*vals, **kwargs)
+
+  def array(self, size=0):
+    return StructArray(self, size)
+
+  def soa(self, size=0):
+    return StructOfArrays(self, size)
+
+  def __repr__(self):
+    return 'Struct(%r, %r)' % (self.name, self.fields)
+
+
+class StructArray(cppinl.CHandle):
+  ''' An array of structs, a `T*` in C++
+  Elements are ctypes structures aliasing the memory, eg. a[0].x = 5.
+  '''
+  def __init__(self, struct, size=0):
+    cppinl.CHandle.__init__(self, cast=struct.name)
+    self.struct = struct
+    self.size = 0
+    self.data = None
+    self.resize(size)
+
+  def resize(self, n):
+    ''' Sets the number of records, new ones are zeroed '''
+    data = (self.struct.ctype * n)()
+    if self.data is not None:
+      ctypes.memmove(data, self.data, min(n, self.size) * self.itemsize())
+    self.data = data
+    self.size = n
+    self.ptr[0] = ctypes.addressof(data)
+
+  def itemsize(self):
+    return ctypes.sizeof(self.struct.ctype)
+
+  def address(self):
+    return ctypes.addressof(self.data)
+
+  def as_ctypes(self):
+    ''' Returns the ctypes array of the records, no data is copied '''
+    return self.data
+
+  def field(self, name):
+    ''' Returns a copy of one field of every record as an array.array '''
+    ctype = vectors.DTYPES[dict(self.struct.fields)[name]]
+    return array.array(vectors._array_typecode(ctype), 
+        [getattr(rec, name) for rec in self.data])
+
+  @property
+  def __array_interface__(self):
+    ''' Lets NumPy alias the records as a structured array '''
+    descr = []
+    pos = 0
+    for fname, dtype in self.struct.fields:
+      offset = getattr(self.struct.ctype, fname).offset
+      if offset > pos:
+        descr.append(('', '|V%d' % (offset - pos)))
+      descr.append((fname, vectors.dtype_typestr(dtype)))
+      pos = offset + ctypes.sizeof(vectors.DTYPES[dtype])
+    if self.itemsize() > pos:
+      descr.append(('', '|V%d' % (self.itemsize() - pos)))
+    return {
+        'version' : 3,
+        'shape' : (self.size,),
+        'typestr' : '|V%d' % self.itemsize(),
+        'descr' : descr,
+        'data' : (self.address(), False),
+    }
+
+  def __getitem__(self, idx):
+    if idx < 0:
+      idx += self.size
+    if not 0 <= idx < self.size:
+      raise IndexError(idx)
+    return self.data[idx]
+
+  def __setitem__(self, idx, rec):
+    ''' Stores a record, a ctypes structure or a tuple of the fields '''
+    if isinstance(rec, tuple):
+      rec = self.struct.ctype(*rec)
+    if idx < 0:
+      idx += self.size
+    if not 0 <= idx < self.size:
+      raise IndexError(idx)
+    self.data[idx] = rec
+
+  def __len__(self):
+    return self.size
+
+  def __iter__(self):
+    return iter(self.data)
+
+  def __repr__(self):
+    return 'StructArray(%s, size=%d)' % (self.struct.name, self.size)
+
+
+class StructOfArrays(cppinl.CHandle):
+  ''' A CVector per field of a struct, a `T_soa*` in C++
+  The vectors are attributes named after the fields, eg. s.x[0] = 5. They
+  may be grown on their own (eg. s.x.extend(...)), but must have the same
+  length when passed to C++.
+  '''
+  def __init__(self, struct, size=0):
+    cppinl.CHandle.__init__(self, cast=struct.soa_name)
+    self.struct = struct
+    self.columns = {}
+    for fname, dtype in struct.fields:
+      self.columns[fname] = vectors.CVector(dtype)
+    self.pointers = struct.soa_ctype()
+    self.ptr[0] = ctypes.addressof(self.pointers)
+    self.resize(size)
+
+  def resize(self, n):
+    ''' Sets the number of records, new ones are zeroed '''
+    for vec in self.columns.values():
+      vec.resize(n)
+
+  @property
+  def _as_parameter_(self):
+    ''' Points the struct at the columns, which may have moved, and returns
+    the T_soa** passed to C++
+    '''
+    lengths = set(len(vec) for vec in self.columns.values())
+    if len(lengths) > 1:
+      raise ValueError('columns of %s have different lengths: %s' % (
+          self.struct.soa_name, ', '.join(map(str, sorted(lengths)))))
+    for fname, vec in self.columns.items():
+      setattr(self.pointers, fname, vec.address())
+    return self.ptr
+
+  def __getattr__(self, name):
+    columns = self.__dict__.get('columns', {})
+    if name in columns:
+      return columns[name]
+    raise AttributeError(name)
+
+  def __getitem__(self, idx):
+    ''' Returns a copy of a record '''
+    return self.struct.ctype(*[self.columns[fname][idx]
+        for fname in self.struct.field_names()])
+
+  def __setitem__(self, idx, rec):
+    ''' Stores a record, a ctypes structure or a tuple of the fields '''
+    if not isinstance(rec, tuple):
+      rec = tuple(getattr(rec, fname) for fname in self.struct.field_names())
+    for fname, v in zip(self.struct.field_names(), rec):
+      self.columns[fname][idx] = v
+
+  def __len__(self):
+    return len(self.columns.values()[0]) if self.columns else 0
+
+  def __repr__(self):
+    return 'StructOfArrays(%s, size=%d)' % (self.struct.name, len(self))
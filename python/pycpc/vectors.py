@@ -1,5 +1,10 @@
+import array
 import cppinl
 import context
+import ctypes
+import ctypes.util
+import os
+import sys
 
 """
 Handy tools for using pycpc
@@ -7,33 +12,226 @@ Handy tools for using pycpc
 
 _ctx = None
 _lib = None
+_runtime = None
 
-def _init_if_needed():
-  global _ctx, _lib
-  if _ctx is not None:
-    return
+# how vectors allocate memory, 'native' uses a small C++ support library
+# which is compiled once per machine (see cache.py), 'libc' calls malloc 
+# through ctypes and needs no compiler at all
+ALLOCATOR = os.environ.get('PYCPC_ALLOCATOR', 'native')
+
+# __array_interface__ byte order
+_endian = '<' if sys.byteorder == 'little' else '>'
+
+
+def _runtime_builder():
+  global _ctx
   _ctx = context.Context()
   __lbuild = context.CPPLibBuilder(_ctx)
-  ptr = cppinl.CHandle(long)
-  dptr = cppinl.CHandle(float)
-  
-  __lbuild.decl_func('long_alloc', r'''
-    p = new int64_t[len];
-  ''', p=ptr, len=long)
-
-  __lbuild.decl_func('long_free', r'''
-    delete [] p;
+  ptr = cppinl.CHandle()
+
+  # grows the allocation to at least need elements, keeping the first used
+  __lbuild.decl_func('pycpc_vec_reserve', r'''
+    if (need <= cap)
+      return cap;
+    int64_t ncap = need;
+    if (grow && 2 * cap > ncap)
+      ncap = 2 * cap;
+    if (align < (int64_t) sizeof(void*))
+      align = sizeof(void*);
+    size_t nbytes = ncap * elsize;
+    void* np = NULL;
+    if (posix_memalign(&np, align, nbytes ? nbytes : 1) != 0)
+      return -1;
+    if (p != NULL) {
+      memcpy(np, p, used * elsize);
+      free(p);
+    }
+    p = np;
+    return ncap;
+  ''', p=ptr, used=long, cap=long, need=long, elsize=long, align=long, 
+      grow=long, rtype=long)
+
+  __lbuild.decl_func('pycpc_vec_free', r'''
+    free(p);
+    p = NULL;
   ''', p=ptr)
 
-  __lbuild.decl_func('dub_alloc', r'''
-    p = new double[len];
-  ''', p=dptr, len=long)
+  # memory allocated by C++ with new[]
+  __lbuild.decl_func('pycpc_vec_delete', r'''
+    delete [] (char*) p;
+    p = NULL;
+  ''', p=ptr)
+  return __lbuild
+
+
+class _NativeRuntime(object):
+  ''' Vector memory management through the compiled support library '''
+  def __init__(self, lib):
+    self.lib = lib
+
+  def reserve(self, p, used, cap, need, elsize, align, grow):
+    return self.lib['pycpc_vec_reserve'](p=p, used=used, cap=cap, need=need, 
+        elsize=elsize, align=align, grow=grow)
+
+  def free(self, p):
+    self.lib['pycpc_vec_free'](p=p)
+
+  def delete(self, p):
+    self.lib['pycpc_vec_delete'](p=p)
+
+
+class _LibcRuntime(object):
+  ''' Vector memory management calling libc directly, nothing is compiled
+  Allocations are compatible with _NativeRuntime, both use posix_memalign.
+  '''
+  def __init__(self):
+    libc = ctypes.CDLL(ctypes.util.find_library('c'))
+    self.posix_memalign = libc.posix_memalign
+    self.posix_memalign.argtypes = [ctypes.POINTER(ctypes.c_void_p), 
+        ctypes.c_size_t, ctypes.c_size_t]
+    self.posix_memalign.restype = ctypes.c_int
+    self.libc_free = libc.free
+    self.libc_free.argtypes = [ctypes.c_void_p]
+    self.libc_free.restype = None
+
+  def reserve(self, p, used, cap, need, elsize, align, grow):
+    if need <= cap:
+      return cap
+    ncap = need
+    if grow and 2 * cap > ncap:
+      ncap = 2 * cap
+    align = max(align, ctypes.sizeof(ctypes.c_void_p))
+    out = ctypes.c_void_p()
+    if self.posix_memalign(ctypes.byref(out), align, max(ncap * elsize, 1)):
+      return -1
+    old = ctypes.cast(p.ptr[0], ctypes.c_void_p).value
+    if old:
+      ctypes.memmove(out.value, old, used * elsize)
+      self.libc_free(old)
+    p.ptr[0] = ctypes.cast(out, type(p.ptr[0]))
+    return ncap
+
+  def free(self, p):
+    self.libc_free(ctypes.cast(p.ptr[0], ctypes.c_void_p))
+    p.ptr[0] = None
+
+  def delete(self, p):
+    # delete[] needs C++, so this is the one operation which compiles, once
+    _NativeRuntime(_native_lib()).delete(p)
+
+
+def use_allocator(name):
+  ''' Selects how vectors allocate memory, either 'native' or 'libc'
+  Memory allocated by either can be freed by the other.
+  '''
+  global ALLOCATOR, _runtime
+  if name not in ('native', 'libc'):
+    raise ValueError('unknown allocator: %s' % name)
+  ALLOCATOR = name
+  _runtime = None
+  _init_if_needed()
+
+
+def _native_lib():
+  ''' Returns the support library, compiling (or loading) it on first use '''
+  global _lib
+  if _lib is None:
+    _lib = _runtime_builder().make()
+  return _lib
+
+
+def _init_if_needed():
+  global _runtime
+  if _runtime is not None:
+    return
+  if ALLOCATOR == 'libc':
+    _runtime = _LibcRuntime()
+    return
+  _runtime = _NativeRuntime(_native_lib())
+
+
+def _init_if_cached():
+  ''' Loads the runtime now if that does not need the compiler '''
+  if ALLOCATOR == 'libc' or _runtime_builder().is_cached():
+    _init_if_needed()
 
-  __lbuild.decl_func('dub_free', r'''
-    delete [] p;
-  ''', p=dptr)
 
-  _lib = __lbuild.make()
+# element types of CVector, the names follow NumPy
+DTYPES = {'float32' : ctypes.c_float, 'float64' : ctypes.c_double}
+for _bits in (8, 16, 32, 64):
+  DTYPES['int%d' % _bits] = getattr(ctypes, 'c_int%d' % _bits)
+  DTYPES['uint%d' % _bits] = getattr(ctypes, 'c_uint%d' % _bits)
+
+# python types accepted as dtypes
+_dtype_aliases = {long : 'int64', int : 'int32', float : 'float64'}
+
+# alignment of allocations when none is given, the same as malloc
+DEFAULT_ALIGN = 16
+
+
+def dtype_name(dtype):
+  ''' Returns the name in DTYPES of a name, python type or ctypes type
+  >>> dtype_name(long)
+  'int64'
+  >>> dtype_name(ctypes.c_float)
+  'float32'
+  '''
+  if dtype in DTYPES:
+    return dtype
+  if dtype in _dtype_aliases:
+    return _dtype_aliases[dtype]
+  for name, ctype in DTYPES.items():
+    if ctype is dtype:
+      return name
+  raise Exception('unknown dtype: %s' % (dtype,))
+
+
+def dtype_typestr(dtype):
+  ''' Returns the NumPy array interface type string of a dtype
+  >>> dtype_typestr('uint8')[1:]
+  'u1'
+  '''
+  name = dtype_name(dtype)
+  kind = name[0] if name[0] in 'fu' else 'i'
+  return '%s%s%d' % (_endian, kind, ctypes.sizeof(DTYPES[name]))
+
+
+def _array_typecode(ctype):
+  ''' Returns the array.array typecode with the same layout as a ctypes type
+  >>> _array_typecode(ctypes.c_double)
+  'd'
+  >>> array.array(_array_typecode(ctypes.c_int64)).itemsize
+  8
+  '''
+  floats = {ctypes.c_float : 'f', ctypes.c_double : 'd'}
+  if ctype in floats:
+    return floats[ctype]
+  codes = 'bhilq' if ctype(-1).value < 0 else 'BHILQ'
+  for code in codes:
+    try:
+      if array.array(code).itemsize == ctypes.sizeof(ctype):
+        return code
+    except ValueError:
+      # 'q' is not available in every python
+      pass
+  raise Exception('no array type for %s' % ctype)
+
+
+def _is_bytes(obj):
+  return isinstance(obj, (str, bytearray, buffer, memoryview))
+
+
+def _bytes_address(obj):
+  ''' Returns (address, keep) of a bytes like object, keep must stay alive '''
+  if isinstance(obj, str):
+    keep = ctypes.c_char_p(obj)
+    return ctypes.cast(keep, ctypes.c_void_p).value, keep
+  if isinstance(obj, bytearray):
+    if not len(obj):
+      return 0, None
+    keep = (ctypes.c_char * len(obj)).from_buffer(obj)
+    return ctypes.addressof(keep), keep
+  return _bytes_address(bytes(obj))
 
 
 class BasicIt(object):
@@ -47,74 +245,156 @@ class BasicIt(object):
       return self.l[self.i-1]
     raise StopIteration
 
-class CLongVector(cppinl.CHandle):
-  def __init__(self):
+class CVector(cppinl.CHandle):
+  ''' A native array of dtype elements, usable wherever a T* is expected
+  The vector owns memory it allocates (through allocate, reserve, resize or
+  append) and frees it when garbage collected, on free(), or when used as a
+  context manager:
+
+      with CVector('float32', size=1024, align=64) as v:
+        lib.kernel(v, len(v))
+
+  Growth is geometric, so appending n elements takes O(n) time. Owned memory
+  must not be deleted in C++. Memory assigned by C++ through the handle 
+  (eg. `v = new int64_t[n];`) is not owned, set_size gives the vector its
+  length.
+  '''
+  dtype = None
+
+  def __init__(self, dtype=None, size=0, align=None):
+    ''' 
+    \param dtype the element type, a name in DTYPES (eg. 'int16'), or one of
+        long, int, float
+    \param size the initial number of elements, which are zeroed
+    \param align alignment of the allocation in bytes, a power of two
+    '''
     _init_if_needed()
-    cppinl.CHandle.__init__(self, typ=long)
+    if dtype is None:
+      dtype = self.dtype
+    self.dtype = dtype_name(dtype)
+    self.ctype = DTYPES[self.dtype]
+    self.typestr = dtype_typestr(self.dtype)
+    if align is None:
+      align = DEFAULT_ALIGN
+    if align & (align - 1):
+      raise ValueError('alignment must be a power of two: %s' % align)
+    self.align = align
+    cppinl.CHandle.__init__(self, typ=self.ctype)
     self.size = 0
+    self.capacity = 0
+    # the address of memory owned by this vector
+    self._owned = None
+    if size:
+      self.resize(size)
 
   def set_size(self, size):
     self.size = long(size)
 
+  def _reserve(self, need, grow):
+    foreign = None
+    used = min(self.size, self.capacity)
+    if self._owned is None or self._owned != self.address():
+      # memory from C++ is copied into a new allocation, but not freed
+      foreign = self.address()
+      self._owned = None
+      self.ptr[0] = None
+      self.capacity = 0
+      used = 0
+    cap = _runtime.reserve(self, used, self.capacity, need, self.itemsize(),
+        self.align, int(grow))
+    if cap < 0:
+      raise MemoryError('cannot allocate %d elements of %s' % (need, 
+          self.dtype))
+    self.capacity = cap
+    self._owned = self.address()
+    if foreign:
+      ctypes.memmove(self._owned, foreign, min(self.size, need) * 
+          self.itemsize())
+
+  def reserve(self, n):
+    ''' Makes room for at least n elements without changing the size '''
+    if n > self.capacity or self._owned is None:
+      self._reserve(n, grow=False)
+
+  def resize(self, n):
+    ''' Sets the number of elements, new elements are zeroed '''
+    if n > self.capacity or self._owned is None:
+      self._reserve(n, grow=True)
+    if n > self.size:
+      ctypes.memset(self.address() + self.size * self.itemsize(), 0, 
+          (n - self.size) * self.itemsize())
+    self.size = long(n)
+
+  def append(self, v):
+    if self.size >= self.capacity or self._owned is None:
+      self._reserve(self.size + 1, grow=True)
+    self.ptr[0][self.size] = v
+    self.size += 1
+
+  def extend(self, seq):
+    ''' Appends every element of seq (see copy_from) '''
+    addr, n, keep = self._source(seq)
+    start = self.size
+    if start + n > self.capacity or self._owned is None:
+      # seq may alias the memory reallocated, eg. v.extend(v), in which case
+      # it is copied from where its elements move
+      inside = None
+      if self._owned is not None and self._owned == self.address():
+        inside = addr - self._owned
+        if not 0 <= inside < self.capacity * self.itemsize():
+          inside = None
+      self._reserve(start + n, grow=True)
+      if inside is not None:
+        addr = self.address() + inside
+    # seq is converted and memory reserved first, so a failure leaves the
+    # vector as it was
+    self.size = start + n
+    self._copy_in(addr, n, start)
+
   def allocate(self, size):
+    ''' Allocates exactly size (uninitialized) elements, dropping the old ones
+    '''
+    self.release()
     self.set_size(size)
-    _lib['long_alloc'](p=self, len=self.size)
-
-  def __setslice__(self, i, j, seq):
-    if i > j: 
-      raise Exception('cannot get a reversed slice.')
-    if i < 0:
-      raise Exception('???')
-    i = min(i, self.size)
-    j = min(j, self.size)
-
-    if len(seq) != (j - i):
-      raise Exception('cannot set splice of size %s to a seq of size %s' % (j-i, len(seq)))
-
-    for idx, v in enumerate(seq):
-      self[i + idx] = v
+    self._reserve(size, grow=False)
 
   def free(self):
-    _lib['long_free'](p=self)
+    ''' Frees the memory, which may also have been allocated in C++ with new[]
+    A view only drops its pointer, the memory belongs to its base.
+    '''
+    if self._owned is not None and self._owned == self.address():
+      self.release()
+    elif getattr(self, 'base', None) is not None:
+      self.release()
+    elif self.address():
+      _runtime.delete(self)
     self.set_size(0)
 
-  def __getitem__(self, idx):
-    if idx < 0:
-      idx += self.size
-    idx = max(idx, 0)
-    return self.ptr[0][idx]
-
-  def __setitem__(self, idx, v):
-    if idx < 0:
-      idx += self.size
-    self.ptr[0][idx] = v
-
-  def __len__(self):
-    return self.size
-
-  def __iter__(self):
-    return BasicIt(self)
-
-  def __str__(self):
-    return '['+', '.join(map(str, self)) +']'
-
-  def __repr__(self):
-    return '['+', '.join(map(repr, self)) +']'
-
-
-
-class CDoubleVector(cppinl.CHandle):
-  def __init__(self):
-    _init_if_needed()
-    cppinl.CHandle.__init__(self, typ=float)
+  def release(self):
+    ''' Frees memory owned by the vector, foreign memory is left alone '''
+    if self._owned is not None and self._owned == self.address():
+      _runtime.free(self)
+    elif getattr(self, 'base', None) is not None:
+      # a view which never reallocated, see view()
+      self.ptr[0] = None
+      self.base = None
+    self._owned = None
+    self.capacity = 0
     self.size = 0
 
-  def set_size(self, size):
-    self.size = long(size)
+  def __enter__(self):
+    return self
 
-  def allocate(self, size):
-    self.set_size(size)
-    _lib['dub_alloc'](p=self, len=self.size)
+  def __exit__(self, *exc):
+    self.release()
+
+  def __del__(self):
+    try:
+      if self._owned is not None and _runtime is not None:
+        self.release()
+    except AttributeError:
+      # partly constructed
+      pass
 
   def __setslice__(self, i, j, seq):
     if i > j: 
@@ -127,20 +407,183 @@ class CDoubleVector(cppinl.CHandle):
     if len(seq) != (j - i):
       raise Exception('cannot set splice of size %s to a seq of size %s' % (j-i, len(seq)))
 
-    for idx, v in enumerate(seq):
-      self[i + idx] = v
-
-  def free(self):
-    _lib['dub_free'](p=self)
-    self.set_size(0)
+    self.copy_from(seq, i)
+
+  def itemsize(self):
+    return ctypes.sizeof(self.ctype)
+
+  def typecode(self):
+    ''' The array.array typecode of the elements '''
+    return _array_typecode(self.ctype)
+
+  def _source(self, src):
+    ''' Returns (address, count, keep) for copying src into this vector
+    Arrays of the same element type and bytes are used in place, anything
+    else is converted to an array.array first. keep must stay alive until
+    the copy is done.
+    '''
+    if _is_bytes(src):
+      if len(src) % self.itemsize():
+        raise ValueError('%d bytes is not a multiple of the element size' % 
+            len(src))
+      addr, keep = _bytes_address(src)
+      return addr, len(src) // self.itemsize(), keep
+    if cppinl.buffer_format(src) == self.typestr[1:]:
+      iface = getattr(src, '__array_interface__', None)
+      if iface is None or iface.get('strides') is None:
+        n = len(src) if iface is None else reduce(lambda a, b: a * b, 
+            iface['shape'], 1)
+        return cppinl.buffer_address(src), n, src
+    src = array.array(self.typecode(), src)
+    return src.buffer_info()[0], len(src), src
+
+  def copy_from(self, src, offset=0):
+    ''' Copies src into the vector starting at element offset
+    src may be a list or other sequence, an array.array, NumPy array, bytes
+    or bytearray. Whole ranges are moved with a single memmove.
+    '''
+    addr, n, keep = self._source(src)
+    self._copy_in(addr, n, offset)
+
+  def _copy_in(self, addr, n, offset):
+    ''' Copies n elements at addr (from _source) to element offset '''
+    if offset < 0 or offset + n > self.size:
+      raise IndexError('cannot copy %d elements to offset %d of a vector of '
+          'size %d' % (n, offset, self.size))
+    if n:
+      ctypes.memmove(self.address() + offset * self.itemsize(), addr, 
+          n * self.itemsize())
+
+  @classmethod
+  def from_buffer(cls, src, dtype=None):
+    ''' Allocates a new vector holding a copy of src (see copy_from)
+    \param dtype the element type (default: the class's, or that of the
+        array src)
+    '''
+    if dtype is None and cls.dtype is None:
+      fmt = cppinl.buffer_format(src)
+      if fmt not in cppinl.BUFFER_TYPES:
+        raise ValueError('cannot tell the dtype of %s, give one' % type(src))
+      dtype = cppinl.BUFFER_TYPES[fmt]
+    vec = cls(dtype)
+    addr, n, keep = vec._source(src)
+    vec.allocate(n)
+    vec._copy_in(addr, n, 0)
+    return vec
+
+  def _range(self, start, stop):
+    if stop is None or stop > self.size:
+      stop = self.size
+    start = min(max(start, 0), stop)
+    return start, stop
+
+  def to_bytes(self, start=0, stop=None):
+    ''' Returns a copy of the elements [start, stop) as a string of bytes '''
+    start, stop = self._range(start, stop)
+    if start == stop:
+      return ''
+    return ctypes.string_at(self.address() + start * self.itemsize(), 
+        (stop - start) * self.itemsize())
+
+  def to_array(self, start=0, stop=None):
+    ''' Returns a copy of the elements [start, stop) as an array.array '''
+    out = array.array(self.typecode())
+    out.fromstring(self.to_bytes(start, stop))
+    return out
+
+  def copy_to(self, out, offset=0):
+    ''' Copies elements starting at offset into out, filling it
+    out is a writable array.array, NumPy array or bytearray.
+    \return the number of elements copied
+    '''
+    if isinstance(out, bytearray):
+      n = len(out) // self.itemsize()
+    elif cppinl.buffer_format(out) == self.typestr[1:]:
+      cppinl.check_pointer(out)
+      n = len(out)
+    else:
+      raise TypeError('cannot copy %s elements to %s' % (self.typestr, 
+          type(out)))
+    n = max(min(n, self.size - offset), 0)
+    if n:
+      if isinstance(out, bytearray):
+        dst, keep = _bytes_address(out)
+      else:
+        dst = cppinl.buffer_address(out)
+      ctypes.memmove(dst, self.address() + offset * self.itemsize(), 
+          n * self.itemsize())
+    return n
+
+  def view(self, offset, length=None):
+    ''' Returns a vector aliasing length elements from offset, no data is
+    copied. The memory stays owned by this vector, which the view keeps alive.
+    '''
+    start, stop = self._range(offset, 
+        None if length is None else offset + length)
+    v = self._view_class()(self.dtype, align=self.align)
+    if self.address():
+      v.ptr[0] = ctypes.cast(self.address() + start * self.itemsize(), 
+          ctypes.POINTER(self.ctype))
+    v.size = stop - start
+    v.base = self
+    return v
+
+  def _view_class(self):
+    ''' The class of views, overridden by subclasses with other constructors
+    '''
+    return type(self)
+
+  def address(self):
+    ''' Returns the address of the first element, 0 if unallocated '''
+    return ctypes.cast(self.ptr[0], ctypes.c_void_p).value or 0
+
+  def as_ctypes(self):
+    ''' Returns a ctypes array aliasing the elements, no data is copied '''
+    if not self.address():
+      raise ValueError('vector has no memory')
+    return (self.ctype * self.size).from_address(self.address())
+
+  def memoryview(self):
+    ''' Returns a memoryview aliasing the elements, no data is copied '''
+    return memoryview(self.as_ctypes())
+
+  @property
+  def __array_interface__(self):
+    ''' Lets NumPy alias the elements, eg. numpy.asarray(v) '''
+    return {
+        'version' : 3,
+        'shape' : (self.size,),
+        'typestr' : self.typestr,
+        'data' : (self.address(), False),
+    }
+
+  def numpy(self):
+    ''' Returns a NumPy array aliasing the elements, no data is copied
+    The array is only valid while the memory is allocated.
+    '''
+    import numpy
+    return numpy.asarray(self)
 
   def __getitem__(self, idx):
+    ''' Gets an element, or a copy of a slice as an array.array '''
+    if isinstance(idx, slice):
+      start, stop, step = idx.indices(self.size)
+      if step == 1:
+        return self.to_array(start, stop)
+      return array.array(self.typecode(), self.as_ctypes()[start:stop:step])
     if idx < 0:
       idx += self.size
     idx = max(idx, 0)
     return self.ptr[0][idx]
 
   def __setitem__(self, idx, v):
+    if isinstance(idx, slice):
+      start, stop, step = idx.indices(self.size)
+      if step == 1:
+        return self.__setslice__(start, stop, v)
+      for i, x in zip(xrange(start, stop, step), v):
+        self.ptr[0][i] = x
+      return
     if idx < 0:
       idx += self.size
     self.ptr[0][idx] = v
@@ -149,7 +592,8 @@ class CDoubleVector(cppinl.CHandle):
     return self.size
 
   def __iter__(self):
-    return BasicIt(self)
+    # one copy out of native memory instead of an access per element
+    return iter(self.to_array())
 
   def __str__(self):
     return '['+', '.join(map(str, self)) +']'
@@ -157,3 +601,15 @@ class CDoubleVector(cppinl.CHandle):
   def __repr__(self):
     return '['+', '.join(map(repr, self)) +']'
 
+
+class CLongVector(CVector):
+  ''' A CVector of int64_t '''
+  dtype = 'int64'
+
+
+class CDoubleVector(CVector):
+  ''' A CVector of double '''
+  dtype = 'float64'
+
+
+_init_if_cached()